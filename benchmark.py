@@ -0,0 +1,231 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import world_2d_v3 as world2d
+from world_2d_v3 import Stone, Sand, Water, Fire, Wood, Oil, Gunpowder, Fuse
+
+
+def scene_empty(world):
+    """
+    何も置かれていないワールドです。
+    """
+    return np.zeros((world.width, world.height), dtype=np.uint8)
+
+
+def scene_sand_pile(world):
+    """
+    石の床の上に、砂の塊を落として山を作ります。
+    """
+    w, h = world.width, world.height
+    ids = scene_empty(world)
+    ids[:, h-2:] = Stone.id
+    ids[w*3//8:w*5//8, :h//2] = Sand.id
+    return ids
+
+
+def scene_water_tank(world):
+    """
+    石の水槽に水を満たし、片側の壁に穴を開けて流れ出させます。
+    """
+    w, h = world.width, world.height
+    ids = scene_empty(world)
+    ids[:, h-2:] = Stone.id
+    ids[w//4, h//4:h-2] = Stone.id
+    ids[w*3//4, h//4:h*3//4] = Stone.id
+    ids[w//4+1:w*3//4, h//4:h-2] = Water.id
+    return ids
+
+
+def scene_oil_fire(world):
+    """
+    石の器に油を張り、その表面に火を付けます。
+    """
+    w, h = world.width, world.height
+    ids = scene_empty(world)
+    ids[:, h-2:] = Stone.id
+    ids[w//8, h//2:h-2] = Stone.id
+    ids[w*7//8, h//2:h-2] = Stone.id
+    ids[w//8+1:w*7//8, h//2:h-2] = Oil.id
+    ids[w//8+1:w*7//8:8, h//2-1] = Fire.id
+    return ids
+
+
+def scene_gunpowder_chain(world):
+    """
+    木の棚に火薬の列を並べ、導火線の端に火を付けます。
+    """
+    w, h = world.width, world.height
+    ids = scene_empty(world)
+    ids[:, h-2:] = Stone.id
+    for shelf in range(h//5, h-2, max(h//5, 4)):
+        ids[w//10:w*9//10, shelf] = Wood.id
+        ids[w//10:w*9//10, shelf-2:shelf] = Gunpowder.id
+    ids[w//10-1, h//5:h-2] = Fuse.id
+    ids[w//10-1, h-3] = Fire.id
+    return ids
+
+
+scenes = {
+    "empty": scene_empty,
+    "sand_pile": scene_sand_pile,
+    "water_tank": scene_water_tank,
+    "oil_fire": scene_oil_fire,
+    "gunpowder_chain": scene_gunpowder_chain,
+}
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if len(values) else 0.0
+
+
+def measure_memory(scene:str, width:int, height:int, ticks:int, warmup:int, seed:int, batched:bool, workers:int = 0) -> int:
+    """
+    run()と同じ更新を、tracemallocで割り当てを追跡しながらもう一度行い、ピークのメモリ使用量を返します。
+    追跡すると更新が数倍遅くなるため、run()の時間の計測とは別に行います。
+
+    Returns:
+        int: ピークのメモリ使用量(バイト)
+    """
+    random.seed(seed)
+    tracemalloc.start()
+    world = world2d.World(width, height, batched, seed, workers)
+    world.load_ids(scenes[scene](world))
+    for _ in range(warmup + ticks):
+        world.step()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if world.pool is not None:
+        world.pool.close()
+    return peak_memory
+
+
+def run(scene:str, width:int, height:int, ticks:int, warmup:int, seed:int, batched:bool, workers:int = 0) -> dict:
+    """
+    1つのシーンを指定した大きさで作り、ticks回更新した結果を返します。
+
+    Parameters:
+        scene (str): シーンの名前 (scenesのキー)
+        width (int): ワールドの幅
+        height (int): ワールドの高さ
+        ticks (int): 計測するtick数
+        warmup (int): 計測前に捨てるtick数
+        seed (int): ワールドの乱数のシード
+        batched (bool): まとめて処理するモードで更新するかどうか
+        workers (int): チャンクを並列に更新するプロセス数
+    Returns:
+        dict: 計測結果
+    """
+    random.seed(seed)
+    world = world2d.World(width, height, batched, seed, workers)
+    world.load_ids(scenes[scene](world))
+    for _ in range(warmup):
+        world.step()
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(ticks):
+        tick_start = time.perf_counter()
+        world.step()
+        latencies.append(time.perf_counter() - tick_start)
+    elapsed = time.perf_counter() - start
+    active_chunks = world.active_chunk_count
+    if world.pool is not None:
+        world.pool.close()
+    peak_memory = measure_memory(scene, width, height, ticks, warmup, seed, batched, workers)
+
+    return {
+        "scene": scene,
+        "width": width,
+        "height": height,
+        "cells": width * height,
+        "batched": batched,
+        "workers": workers,
+        "seed": seed,
+        "ticks": ticks,
+        "ticks_per_second": ticks / elapsed,
+        "cells_per_second": ticks * width * height / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) * 1000,
+        },
+        "peak_memory_bytes": peak_memory,
+        "active_chunks": active_chunks,
+    }
+
+
+def compare(results:list, baseline_path:str, threshold:float) -> list:
+    """
+    以前の結果と比べて、ticks_per_secondがthresholdの割合以上落ちた計測を返します。
+
+    Parameters:
+        results (list): 今回の計測結果
+        baseline_path (str): 以前の結果のJSONファイル
+        threshold (float): 許容する性能低下の割合 (0.2なら20%)
+    Returns:
+        list: (今回の結果, 以前の結果) の組のリスト
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    key = lambda r: (r["scene"], r["width"], r["height"], r["batched"], r.get("workers", 0))
+    previous = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is not None and result["ticks_per_second"] < old["ticks_per_second"] * (1 - threshold):
+            regressions.append((result, old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="World.step() のベンチマーク")
+    parser.add_argument("--scenes", default=",".join(scenes), help="計測するシーン (カンマ区切り)")
+    parser.add_argument("--sizes", default="160x100,320x200,640x400", help="計測するワールドの大きさ (カンマ区切り)")
+    parser.add_argument("--ticks", type=int, default=200, help="計測するtick数")
+    parser.add_argument("--warmup", type=int, default=40, help="計測前に捨てるtick数")
+    parser.add_argument("--seed", type=int, default=0, help="ワールドの乱数のシード")
+    parser.add_argument("--per-cell", action="store_true", help="まとめて処理せず1ブロックずつ更新する")
+    parser.add_argument("--workers", type=int, default=0, help="チャンクを並列に更新するプロセス数")
+    parser.add_argument("--output", default="bench_results.json", help="結果を書き出すJSONファイル")
+    parser.add_argument("--compare", help="比較する以前の結果のJSONファイル")
+    parser.add_argument("--threshold", type=float, default=0.2, help="--compare で許容する性能低下の割合")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes.split(","):
+        width, height = map(int, size.lower().split("x"))
+        for scene in args.scenes.split(","):
+            result = run(scene, width, height, args.ticks, args.warmup, args.seed, not args.per_cell, args.workers)
+            results.append(result)
+            latency = result["latency_ms"]
+            print(f"{scene:16} {width:5}x{height:<5} {result['ticks_per_second']:8.1f} ticks/s "
+                  f"p50 {latency['p50']:7.2f}ms p99 {latency['p99']:7.2f}ms "
+                  f"peak {result['peak_memory_bytes']/1e6:7.1f}MB")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": sys.version,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "results": results,
+        }, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for result, old in regressions:
+            print(f"REGRESSION {result['scene']} {result['width']}x{result['height']}: "
+                  f"{old['ticks_per_second']:.1f} -> {result['ticks_per_second']:.1f} ticks/s")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,594 +1,2896 @@
+import argparse
+import asyncio
+import atexit
+import collections
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
 import pygame 
 import random
 import math
-import socket
+import numpy as np
+import struct
+import zlib
 import threading
+import time
 
 block_w = 5
+chunk_size = 16
+color_noise = 30
+kernel_kinds = ["scalar", "static", "powder", "liquid"]
+stream_move = 0
+stream_ignite = 1
+stream_color = 2
+next_offsets = ((0, 1), (1, 0), (0, -1), (-1, 0))
 multiplayer = False
 isHost = False
 
+mask64 = (1 << 64) - 1
+hash_keys = (0x9E3779B97F4A7C15, 0xBF58476D1CE4E5B9, 0x94D049BB133111EB, 0xD6E8FEB86659FD93)
+
+
+def hash_random(seed:int, tick:int, x:int, y:int, stream:int = 0) -> float:
+    """
+    seed, tick, x, y, streamだけで決まる、0以上1未満の乱数を返します。
+    同じ値を渡せば、どのマシンでもどの順番で呼んでも同じ結果になります。
+
+    Parameters:
+        seed (int): ワールドのシード
+        tick (int): tick番号
+        x (int): x座標
+        y (int): y座標
+        stream (int): 同じセルの同じtickで別の乱数が必要な時に使い分ける番号 (stream_*)
+    Returns:
+        float: 0以上1未満の乱数
+    """
+    z = seed ^ (tick * hash_keys[0]) ^ (int(x) * hash_keys[1]) ^ (int(y) * hash_keys[2]) ^ (stream * hash_keys[3])
+    z &= mask64
+    z = ((z ^ (z >> 30)) * hash_keys[1]) & mask64
+    z = ((z ^ (z >> 27)) * hash_keys[2]) & mask64
+    z ^= z >> 31
+    return (z >> 11) * 2.0**-53
+
+
+def hash_random_array(seed:int, tick:int, xs, ys, stream:int = 0):
+    """
+    hash_random()と同じ乱数を、座標の配列に対してまとめて計算します。
+
+    Parameters:
+        seed (int): ワールドのシード
+        tick (int): tick番号
+        xs (numpy.ndarray): x座標の配列
+        ys (numpy.ndarray): xsとブロードキャストできるy座標の配列
+        stream (int): 乱数の種類の番号 (stream_*)
+    Returns:
+        numpy.ndarray: 0以上1未満の乱数の配列
+    """
+    keys = np.array(hash_keys, dtype=np.uint64)
+    base = np.uint64((seed ^ (tick * hash_keys[0]) ^ (stream * hash_keys[3])) & mask64)
+    z = base ^ (np.asarray(xs, dtype=np.uint64) * keys[1]) ^ (np.asarray(ys, dtype=np.uint64) * keys[2])
+    z = (z ^ (z >> np.uint64(30))) * keys[1]
+    z = (z ^ (z >> np.uint64(27))) * keys[2]
+    z ^= z >> np.uint64(31)
+    return (z >> np.uint64(11)) * 2.0**-53
+
+
+blast_path_tables = {}
+
+def blast_paths(radius:int):
+    """
+    爆発の中心の隣から、来た向きに戻らずに1マスずつ広がる経路が、各セルを通る回数を返します。
+    隣のブロックから再帰的にimpactを呼んでいた頃に、1回の爆発が各セルに損傷を与えていた回数と同じです。
+    半径ごとに一度だけ計算し、blast_path_tablesに保持します。
+
+    Parameters:
+        radius (int): 爆発の届く距離
+    Returns:
+        numpy.ndarray: 中心から dx, dy 離れたセルを通る経路の数を [dx+radius, dy+radius] に持つ配列
+    """
+    table = blast_path_tables.get(radius)
+    if table is None:
+        size = 2*radius + 1
+        table = np.zeros((size, size), dtype=np.int64)
+        for i, (dx, dy) in enumerate(next_offsets):
+            back = (i + 2) % 4
+            paths = np.zeros((size, size), dtype=np.int64)
+            paths[radius+dx, radius+dy] = 1
+            for _ in range(radius):
+                table += paths
+                paths = sum(np.roll(paths, offset, axis=(0, 1)) for j, offset in enumerate(next_offsets) if j != back)
+        blast_path_tables[radius] = table
+    return table
+
+
+save_magic = b"W2DSAVE\0"
+save_version = 1
+save_header = struct.Struct("<8sHIIQQI")
+save_section = struct.Struct("<16s8sQ")
+save_align = 64
+save_material = struct.Struct("<BB")
+
+
+def write_save(path:str, snapshot:dict):
+    """
+    World.snapshot()の内容を、バージョン付きのバイナリ形式でファイルに保存します。
+
+    ファイルはヘッダ(マジック、バージョン、幅、高さ、tick、シード、セクション数)の後に、
+    セクション(名前、dtype、バイト数)を並べたものです。
+    最初のセクションはブロックのidと名前の対応表で、その後にセルの配列が (幅, 高さ) のC順で続きます。
+    配列のデータはsave_alignバイト境界から始まるため、そのままメモリマップで読み込めます。
+    配列は列の束ごとに書き出すため、保存のために配列全体をもう一つ作ることはありません。
+    書き終わるまでは一時ファイルに書き、最後に置き換えます。
+
+    Parameters:
+        path (str): 保存先のファイル名
+        snapshot (dict): World.snapshot()の戻り値
+    """
+    materials = b"".join(
+        save_material.pack(id, len(block.__name__)) + block.__name__.encode() for id, block in sorted(block_types.items())
+    )
+    sections = [("materials", "", materials)]
+    sections += [(name, array.dtype.str, array) for name, array in snapshot["arrays"].items()]
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(save_header.pack(
+            save_magic, save_version, snapshot["width"], snapshot["height"],
+            snapshot["tick"], snapshot["seed"], len(sections),
+        ))
+        for name, dtype, data in sections:
+            f.write(save_section.pack(name.encode(), dtype.encode(), len(data) if dtype == "" else data.nbytes))
+            f.write(bytes(-f.tell() % save_align))
+            if dtype == "":
+                f.write(data)
+                continue
+            for x in range(0, data.shape[0], chunk_size):
+                f.write(np.ascontiguousarray(data[x:x+chunk_size]).data)
+    os.replace(temp_path, path)
+
+
+def read_save(path:str, use_mmap:bool = True) -> tuple:
+    """
+    write_save()で保存したファイルを読み込みます。
+
+    use_mmapがTrueの場合、配列はコピーオンライトのメモリマップとして開くため、
+    大きなワールドでもすぐに開け、実際に触ったページだけがディスクから読み込まれます。
+
+    Parameters:
+        path (str): 読み込むファイル名
+        use_mmap (bool): 配列をメモリマップで開くかどうか
+    Returns:
+        tuple: (ヘッダのdict, {保存時のid: ブロックの名前}, {配列の名前: numpy.ndarray})
+    """
+    with open(path, "rb") as f:
+        magic, version, width, height, tick, seed, count = save_header.unpack(f.read(save_header.size))
+        if magic != save_magic:
+            raise ValueError(f"{path} is not a world save file")
+        if version > save_version:
+            raise ValueError(f"{path} uses save format version {version}, this build reads up to {save_version}")
+        header = {"version": version, "width": width, "height": height, "tick": tick, "seed": seed}
+        materials = {}
+        arrays = {}
+        offset = f.tell()
+        for _ in range(count):
+            f.seek(offset)
+            name, dtype, size = save_section.unpack(f.read(save_section.size))
+            name, dtype = name.rstrip(b"\0").decode(), dtype.rstrip(b"\0").decode()
+            data_offset = offset + save_section.size
+            data_offset += -data_offset % save_align
+            if name == "materials":
+                f.seek(data_offset)
+                data = f.read(size)
+                i = 0
+                while i < size:
+                    id, length = save_material.unpack_from(data, i)
+                    materials[id] = data[i+save_material.size:i+save_material.size+length].decode()
+                    i += save_material.size + length
+            elif use_mmap:
+                arrays[name] = np.memmap(f, dtype=dtype, mode="c", offset=data_offset, shape=(width, height))
+            else:
+                f.seek(data_offset)
+                arrays[name] = np.fromfile(f, dtype=dtype, count=width*height).reshape(width, height)
+            offset = data_offset + size
+    return header, materials, arrays
+
+
 class World:
-    def __init__(self, w, h):
+    cell_array_names = [
+        "ids", "vx", "vy", "burn_level", "durability",
+        "electric_level", "lifetime", "last_tick", "is_ground", "transform",
+    ]
+    save_array_names = cell_array_names + ["randamize_color"]
+    shared_array_names = ["chunk_changed", "chunk_awake", "tile_mask"]
+
+    def __init__(self, w, h, batched:bool = False, seed:int = None, workers:int = 0):
         """
         ワールドを初期化します。
-        
+
+        セルごとの状態は、ブロックのインスタンスではなく
+        型付きのNumPy配列(structure of arrays)に格納します。
+        配列は全て self.ids[x, y] のように x, y の順で添字を付けます。
+
+        シミュレーションの乱数は全て、seedとtick番号とセルの座標から計算するため、
+        同じseedと同じ状態から更新した結果は常に同じになります。
+        画面に表示するのはview (x0, y0, x1, y1) の範囲のセルで、通常はワールド全体です。
+
         Parameters:
             w (int): ワールドの幅
             h (int): ワールドの高さ
+            batched (bool): 砂や液体の移動をNumPyでまとめて処理するかどうか
+            seed (int): 乱数のシード (Noneならランダムに決めます)
+            workers (int): 1以上なら、チャンクを市松模様の4つのフェーズに分けて更新します。
+                           2以上の場合は、各フェーズのチャンクをそのプロセス数で並列に更新します。
+        """
+
+        self.blocks = block_list()
+        self.id_table = np.array([id if id in block_types else 0 for id in range(256)], dtype=np.uint8)
+        self.width = w
+        self.height = h
+        self.view = (0, 0, w, h)
+        self.tick = 0
+        self.tick_10 = 0
+        self.batched = batched
+        self.renderer = None
+        self.stats = None
+        self.autosave = None
+        self.seed = random.getrandbits(64) if seed is None else seed & mask64
+
+        self.durability_table = np.array([block.durability for block in self.blocks], dtype=np.float32)
+        self.lifetime_table = np.array([block.lifetime for block in self.blocks], dtype=np.int16)
+        self.move_priority_table = np.array([block.move_priority for block in self.blocks], dtype=np.float32)
+        self.invisible_table = np.array([block.invisible for block in self.blocks], dtype=bool)
+        self.color_table = np.array([block.color for block in self.blocks], dtype=np.uint8)
+        self.kernel_table = np.array([kernel_kinds.index(block.kernel) for block in self.blocks], dtype=np.uint8)
+        self.transform_to_table = np.array(
+            [-1 if block.transform_to is None else block.transform_to.id for block in self.blocks], dtype=np.int16
+        )
+        self.fire_chance_table = np.array([block.fire_chance for block in self.blocks], dtype=np.float64)
+        self.can_electric_table = np.array([block.can_electric for block in self.blocks], dtype=bool)
+        self.burn_threshold_table = np.array(
+            [block.burn_threshold if block.can_burn else np.iinfo(np.int16).max for block in self.blocks], dtype=np.int16
+        )
+
+        self.ids = np.zeros((w, h), dtype=np.uint8)
+        self.vx = np.zeros((w, h), dtype=np.float32)
+        self.vy = np.zeros((w, h), dtype=np.float32)
+        self.burn_level = np.zeros((w, h), dtype=np.int16)
+        self.durability = np.full((w, h), Air.durability, dtype=np.float32)
+        self.electric_level = np.zeros((w, h), dtype=np.int16)
+        self.lifetime = np.full((w, h), Air.lifetime, dtype=np.int16)
+        self.last_tick = np.zeros((w, h), dtype=np.int8)
+        self.is_ground = np.zeros((w, h), dtype=bool)
+        self.transform = np.full((w, h), -1, dtype=np.int16)
+        self.cell_arrays = [getattr(self, name) for name in self.cell_array_names]
+        self.tile_mask = np.zeros((w, h), dtype=bool)
+        self.heat_sources = []
+        self.detonations = []
+        self.chunk_w = -(-w // chunk_size)
+        self.chunk_h = -(-h // chunk_size)
+        self.sleep_ticks = 30
+        self.chunk_changed = np.ones((self.chunk_w, self.chunk_h), dtype=bool)
+        self.chunk_idle = np.zeros((self.chunk_w, self.chunk_h), dtype=np.uint16)
+        self.chunk_awake = np.ones((self.chunk_w, self.chunk_h), dtype=bool)
+        self.randamize_color = self.random_area(0, 0, w, h, stream_color, 0) * (color_noise+1)
+        self.randamize_color = self.randamize_color.astype(np.uint8)
+        noise = np.arange(color_noise+1, dtype=np.int16)[None, :, None]
+        self.color_lut = np.clip(self.color_table[:, None, :].astype(np.int16) - noise, 0, 255).astype(np.uint8)
+        self.display_lut = self.color_lut.copy()
+        self.display_lut[self.invisible_table] = 0
+        self.color_cache = [[tuple(color) for color in colors] for colors in self.color_lut.tolist()]
+        self.workers = workers
+        self.pool = TilePool(self, workers) if workers > 1 else None
+
+    def in_area(self, x, y):
+        """
+        指定されたx, y座標がワールドの範囲内にあるかどうかを返します。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+        Returns:
+            bool: ワールドの範囲内にあるかどうか
+        """
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return True
+        return False
+
+    def is_can_move(self, x, y, mvx, mvy):
+        """
+        指定されたx, y座標に mvx, mvy だけ動かす事が出来るかどうかを返します。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+            mvx (int): x方向の移動量
+            mvy (int): y方向の移動量
+        Returns:
+            bool: 動かすことが出来るかどうか
+        """
+        x2, y2 = x+mvx, y+mvy
+        if not (0 <= x < self.width and 0 <= y < self.height and 0 <= x2 < self.width and 0 <= y2 < self.height):
+            return False
+        last_tick = self.last_tick
+        if last_tick[x, y] == self.tick_10 or last_tick[x2, y2] == self.tick_10:
+            return False
+        return self.get_block(x2, y2).move_priority < self.get_block(x, y).move_priority
+
+    def swap_block(self, x1, y1, x2, y2):
+        """
+        x1, y1とx2, y2のブロックを交換します。
+
+        Parameters:
+            x1 (int): 交換するブロック1のx座標
+            y1 (int): 交換するブロック1のy座標
+            x2 (int): 交換するブロック2のx座標
+            y2 (int): 交換するブロック2のy座標
+        """
+        for array in self.cell_arrays:
+            array[x1, y1], array[x2, y2] = array[x2, y2], array[x1, y1]
+        self.last_tick[x1, y1] = self.tick_10
+        self.last_tick[x2, y2] = self.tick_10
+        self.wake(x1, y1)
+        self.wake(x2, y2)
+        if self.stats is not None:
+            self.stats.count("swap_block")
+
+    def set_block(self, x:int, y:int, id:int ,mode:int = 1) -> None:
+        """
+        x, y座標にid番目のブロックを配置します。
+        modeが1の場合は、既にブロックが存在する場合でも強制的に置き換えます。
+        modeが0の場合は、既にブロックが存在する場合は何もしません。
+        """
+
+        id = int(self.id_table[id]) if 0 <= id <= max_block_id else 0
+        if self.in_area(x, y):
+            if mode == 1 or self.ids[x, y] == 0:
+                block = self.blocks[id]
+                self.ids[x, y] = id
+                self.vx[x, y] = 0
+                self.vy[x, y] = 0
+                self.burn_level[x, y] = 0
+                self.durability[x, y] = block.durability
+                self.electric_level[x, y] = 0
+                self.lifetime[x, y] = block.lifetime
+                self.last_tick[x, y] = self.tick_10
+                self.is_ground[x, y] = False
+                self.transform[x, y] = -1
+                self.wake(x, y)
+                if self.stats is not None:
+                    self.stats.count("set_block")
+
+    def load_ids(self, ids):
+        """
+        ワールド全体のブロックをまとめて置き換えます。
+        各セルの状態は、ブロックの種類ごとの初期値に戻ります。
+
+        Parameters:
+            ids (numpy.ndarray): (幅, 高さ)の形をしたブロックidの配列
+        """
+        ids = self.id_table[np.asarray(ids, dtype=np.uint8)]
+        self.ids[:] = ids
+        self.vx.fill(0)
+        self.vy.fill(0)
+        self.burn_level.fill(0)
+        self.durability[:] = self.durability_table[ids]
+        self.electric_level.fill(0)
+        self.lifetime[:] = self.lifetime_table[ids]
+        self.last_tick.fill(self.tick_10)
+        self.is_ground.fill(False)
+        self.transform.fill(-1)
+        self.chunk_changed.fill(True)
+
+    def set_cells(self, indices, ids):
+        """
+        複数のセルのブロックをまとめて置き換えます。
+        置き換えたセルの状態は、ブロックの種類ごとの初期値に戻ります。
+
+        Parameters:
+            indices (numpy.ndarray): セルの位置 (x * 高さ + y) の配列
+            ids (numpy.ndarray): indicesと同じ長さの、ブロックidの配列
+        """
+        ids = self.id_table[np.asarray(ids, dtype=np.uint8)]
+        xs, ys = np.divmod(np.asarray(indices, dtype=np.int64), self.height)
+        self.ids[xs, ys] = ids
+        self.vx[xs, ys] = 0
+        self.vy[xs, ys] = 0
+        self.burn_level[xs, ys] = 0
+        self.durability[xs, ys] = self.durability_table[ids]
+        self.electric_level[xs, ys] = 0
+        self.lifetime[xs, ys] = self.lifetime_table[ids]
+        self.last_tick[xs, ys] = self.tick_10
+        self.is_ground[xs, ys] = False
+        self.transform[xs, ys] = -1
+        self.chunk_changed[xs // chunk_size, ys // chunk_size] = True
+
+    def wake(self, x:int, y:int):
+        """
+        x, y座標を含むチャンクに変化があったことを記録します。
+        次のtickから、そのチャンクと周囲8チャンクが更新対象になります。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+        """
+        self.chunk_changed[x // chunk_size, y // chunk_size] = True
+
+    def update_chunks(self):
+        """
+        前のtickで変化のあったチャンクとその周囲を起こし、
+        sleep_ticksの間変化の無かったチャンクを眠らせます。
+        """
+        changed = self.chunk_changed
+        near = changed.copy()
+        near[1:] |= changed[:-1]
+        near[:-1] |= changed[1:]
+        near[:, 1:] |= near[:, :-1].copy()
+        near[:, :-1] |= near[:, 1:].copy()
+        np.minimum(self.chunk_idle + 1, self.sleep_ticks, out=self.chunk_idle)
+        self.chunk_idle[near] = 0
+        self.chunk_awake[:] = self.chunk_idle < self.sleep_ticks
+        changed.fill(False)
+
+    @property
+    def active_chunk_count(self) -> int:
+        """
+        現在起きている(更新対象の)チャンクの数を返します。
+        """
+        return int(self.chunk_awake.sum())
+
+    def random(self, x:int, y:int, stream:int = stream_move) -> float:
+        """
+        現在のtickのx, y座標で使う、0以上1未満の乱数を返します。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+            stream (int): 乱数の種類の番号 (stream_*)
+        Returns:
+            float: 0以上1未満の乱数
+        """
+        return hash_random(self.seed, self.tick, x, y, stream)
+
+    def random_area(self, x0:int, y0:int, x1:int, y1:int, stream:int = stream_move, tick:int = None):
+        """
+        x0, y0からx1, y1の手前までの範囲の各セルについて、random()と同じ乱数をまとめて返します。
+
+        Parameters:
+            x0 (int): 範囲の左上のx座標
+            y0 (int): 範囲の左上のy座標
+            x1 (int): 範囲の右下のx座標 (含まない)
+            y1 (int): 範囲の右下のy座標 (含まない)
+            stream (int): 乱数の種類の番号 (stream_*)
+            tick (int): tick番号 (Noneなら現在のtick)
+        Returns:
+            numpy.ndarray: (x1-x0, y1-y0)の形をした乱数の配列
+        """
+        tick = self.tick if tick is None else tick
+        return hash_random_array(self.seed, tick, np.arange(x0, x1)[:, None], np.arange(y0, y1)[None, :], stream)
+
+    def random_cells(self, xs, ys, stream:int = stream_move):
+        """
+        xs, ysで指定された各セルについて、random()と同じ乱数をまとめて返します。
+
+        Parameters:
+            xs (numpy.ndarray): x座標の配列
+            ys (numpy.ndarray): xsと同じ形のy座標の配列
+            stream (int): 乱数の種類の番号 (stream_*)
+        Returns:
+            numpy.ndarray: xsと同じ形をした乱数の配列
+        """
+        return hash_random_array(self.seed, self.tick, xs, ys, stream)
+
+    def get_block_id(self, x:int, y:int) -> int:
+        """
+        x, y座標のブロックのidを取得します。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+        Returns:
+            int: ブロックのid
+        """
+        if self.in_area(x, y):
+            return int(self.ids[x, y])
+        return 0
+
+    def get_block(self, x:int, y:int):
+        """
+        x, y座標のブロックの種類(クラス)を取得します。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+        Returns:
+            type: ブロックのクラス
+        """
+        return self.blocks[self.ids[x, y]]
+
+    def randamize(self, x, y):
+        """
+        x, y座標のブロックの色を、乱数に基づいてランダマイズします。
+        色は(ブロックid, 乱数)の組ごとに事前計算したcolor_cacheから引きます。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+        Returns:
+            tuple: (r, g, b)形式の色
+        """
+        return self.color_cache[self.ids[x, y]][self.randamize_color[x, y]]
+
+
+    def render(self, screen:pygame.Surface, x, y):
+        """
+        x, y座標のブロックを描画します。
+
+        Parameters:
+            screen (pygame.Surface): 描画するSurface
+            x (int): x座標
+            y (int): y座標
+        """
+        if not self.get_block(x, y).invisible:
+            pygame.draw.rect(screen, self.randamize(x, y), (x*block_w, y*block_w, block_w, block_w), 0)
+
+    def update(self, screen:pygame.Surface):
+        """
+        全てのブロックを更新し、描画します。
+        step()とdraw()を続けて呼ぶのと同じです。
+
+        Parameters:
+            screen (pygame.Surface): 描画するSurface
+        Returns:
+            list: 描画し直した範囲のpygame.Rectのリスト (rendererが無い場合はNone)
+        """
+        self.step()
+        return self.draw(screen)
+
+    def step(self):
+        """
+        描画は行わずに、全てのブロックを1tick分だけ更新します。
+        """
+        if self.stats is not None:
+            self.stats.begin_tick()
+        self.tick += 1
+        self.tick_10 = (self.tick_10 + 1) % 10
+        self.update_chunks()
+        if self.batched:
+            self.update_batched()
+        elif self.workers:
+            self.update_tiles(False)
+        else:
+            ids = self.ids
+            for x in range(self.width):
+                awake = self.chunk_awake[x // chunk_size]
+                if not awake.any() or not ids[x].any():
+                    continue
+                for y in range(self.height):
+                    if ids[x, y] != 0 and awake[y // chunk_size]:
+                        self.update_cell(x, y)
+        self.resolve_explosions()
+        self.propagate_heat()
+        if self.autosave is not None:
+            if self.stats is not None:
+                start = time.perf_counter()
+            self.autosave.step()
+            if self.stats is not None:
+                self.stats.add("autosave", time.perf_counter() - start)
+        if self.stats is not None:
+            self.stats.end_tick(self)
+
+    def draw(self, screen:pygame.Surface):
+        """
+        ワールドを描画します。
+        rendererが設定されている場合は、変化したセルだけを描画します。
+
+        Parameters:
+            screen (pygame.Surface): 描画するSurface
+        Returns:
+            list: 描画し直した範囲のpygame.Rectのリスト (rendererが無い場合はNone)
+        """
+        if self.stats is not None:
+            start = time.perf_counter()
+        if self.renderer is not None:
+            rects = self.renderer.draw(screen)
+        else:
+            rects = None
+            screen.fill((0, 0, 0))
+            for x, y in zip(*np.nonzero(~self.invisible_table[self.ids])):
+                self.render(screen, x, y)
+        if self.stats is not None:
+            self.stats.add("render", time.perf_counter() - start)
+        return rects
+
+    def update_cell(self, x:int, y:int, screen:pygame.Surface = None):
+        """
+        x, y座標のブロックを1つだけ更新します。
+
+        Parameters:
+            x (int): x座標
+            y (int): y座標
+            screen (pygame.Surface): 描画するSurface (Noneの場合は描画しません)
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        block = self.get_block(x, y)
+        mvx, mvy = block.update(self, x, y)
+        if stats is not None:
+            now = time.perf_counter()
+            stats.add_block(block.__name__, now - start)
+            start = now
+        transform = self.transform[x, y]
+        if transform >= 0:
+            self.set_block(x, y, transform)
+            if stats is not None:
+                stats.add("set_block", time.perf_counter() - start)
+            if screen is not None:
+                self.render(screen, x, y)
+            return
+        if y+1 < self.height:
+            self.is_ground[x, y] = self.get_block(x, y+1).move_priority >= block.move_priority
+        else:
+            self.is_ground[x, y] = True
+
+        if self.is_can_move(x, y, mvx, mvy):
+            self.swap_block(x, y, x+mvx, y+mvy)
+            if screen is not None:
+                self.render(screen, x+mvx, y+mvy)
+        else:
+            if abs(mvx) > abs(mvy):
+                self.vx[x, y] *= 0.5
+            else:
+                self.vy[x, y] *= 0.5
+        if stats is not None:
+            stats.add("move", time.perf_counter() - start)
+        if screen is not None:
+            self.render(screen, x, y)
+
+    def update_batched(self):
+        """
+        静止している砂・液体の移動をNumPyの配列演算でまとめて処理し、
+        残りのブロック(火、燃えているブロック、速度を持つブロックなど)だけを1つずつ更新します。
+
+        移動は方向ごとのフェーズに分けて行い、各フェーズでは
+        移動元と移動先が重ならないよう行(または列)の偶奇で更に2つに分けます。
+        移動先のmove_priorityが自分より小さく、今のtickでまだ処理されていない場合だけ交換する点は
+        1ブロックずつ更新する場合と同じです。
+
+        ただし1ブロックずつ更新する場合は、左の列から順に、上から下へ動かした結果を次のブロックが見るため、
+        山の裾の広がり方と高さが同じになりません。形が一致するまでは、1ブロックずつ更新する方を標準とします。
+
+        Returns:
+            int: まとめて移動したブロックの数
+        """
+        if self.stats is not None:
+            start = time.perf_counter()
+        awake_x, awake_y = np.nonzero(self.chunk_awake)
+        if len(awake_x) == 0:
+            return 0
+        x0 = max(awake_x.min() * chunk_size - 1, 0)
+        x1 = min((awake_x.max()+1) * chunk_size + 1, self.width)
+        y0 = max(awake_y.min() * chunk_size - 1, 0)
+        y1 = min((awake_y.max()+1) * chunk_size + 1, self.height)
+        box = (slice(x0, x1), slice(y0, y1))
+        awake = self.chunk_awake[(np.arange(x0, x1) // chunk_size)[:, None], np.arange(y0, y1) // chunk_size]
+
+        ids = self.ids[box]
+        kind = self.kernel_table[ids]
+        prio = self.move_priority_table[ids]
+        processed = self.last_tick[box] == self.tick_10
+        burning = self.burn_level[box] >= self.burn_threshold_table[ids]
+        resting = (np.abs(self.vx[box]) < 0.5) & (np.abs(self.vy[box]) < 0.5)
+        active = awake & ~burning & (self.transform[box] < 0) & resting
+        powder = active & (kind == kernel_kinds.index("powder"))
+        liquid = active & (kind == kernel_kinds.index("liquid"))
+
+        below = np.full_like(prio, np.inf)
+        below[:, :-1] = prio[:, 1:]
+        if y1 < self.height:
+            below[:, -1] = self.move_priority_table[self.ids[x0:x1, y1]]
+        ground = below >= prio
+        self.is_ground[box][powder | liquid] = ground[powder | liquid]
+        go_right = self.random_area(x0, y0, x1, y1, stream_move) >= 0.5
+
+        rows = np.arange(y0, y1) % 2
+        cols = np.arange(x0, x1)[:, None] % 2
+        moved = 0
+        for p in (0, 1):
+            moved += self.batch_move((powder | liquid) & ~ground & (rows == p), 0, 1, prio, processed, x0, y0)
+        for p in (0, 1):
+            right_free, _ = self.side_free(prio)
+            moved += self.batch_move(powder & ground & right_free & (rows == p), 1, 1, prio, processed, x0, y0)
+        for p in (0, 1):
+            right_free, left_free = self.side_free(prio)
+            moved += self.batch_move(powder & ground & ~right_free & left_free & (rows == p), -1, 1, prio, processed, x0, y0)
+        for p in (0, 1):
+            moved += self.batch_move(liquid & ground & go_right & (cols == p), 1, 0, prio, processed, x0, y0)
+        for p in (0, 1):
+            moved += self.batch_move(liquid & ground & ~go_right & (cols == p), -1, 0, prio, processed, x0, y0)
+
+        if self.stats is not None:
+            self.stats.add("kernel", time.perf_counter() - start)
+            self.stats.count("batched_move", moved)
+
+        rest = awake & (ids != 0) & ((kind == kernel_kinds.index("scalar")) | (self.transform[box] >= 0) | burning)
+        rest |= awake & (kind >= kernel_kinds.index("powder")) & ~resting
+        if self.workers:
+            self.tile_mask.fill(False)
+            self.tile_mask[box] = rest
+            self.update_tiles(True)
+            return moved
+        for x, y in zip(*np.nonzero(rest)):
+            if ids[x, y] != 0:
+                self.update_cell(x0+x, y0+y)
+        return moved
+
+    def update_tiles(self, use_mask:bool):
+        """
+        起きているチャンクをタイルとして、チャンク座標の偶奇で市松模様の4つのフェーズに分けて更新します。
+
+        同じフェーズのタイルの間には必ず1チャンク(chunk_sizeセル)の隙間があります。
+        1つのブロックの更新で読み書きするのは元の位置から数セル(移動量と爆発の範囲)以内なので、
+        同じフェーズのタイルは互いに影響せず、どの順番で、あるいは並列に更新しても結果は同じです。
+
+        Parameters:
+            use_mask (bool): tile_maskが立っているセルだけを更新するかどうか
+        """
+        if self.stats is not None:
+            start = time.perf_counter()
+        awake_x, awake_y = np.nonzero(self.chunk_awake)
+        for px, py in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            phase = (awake_x % 2 == px) & (awake_y % 2 == py)
+            tiles = list(zip(awake_x[phase].tolist(), awake_y[phase].tolist()))
+            if self.pool is not None:
+                self.pool.run(tiles, use_mask)
+            else:
+                for cx, cy in tiles:
+                    self.update_tile(cx, cy, use_mask)
+        if self.stats is not None:
+            self.stats.add("tiles", time.perf_counter() - start)
+
+    def update_tile(self, cx:int, cy:int, use_mask:bool):
+        """
+        1つのチャンクのブロックを、1ブロックずつ更新する場合と同じ順番で更新します。
+
+        Parameters:
+            cx (int): チャンクのx座標
+            cy (int): チャンクのy座標
+            use_mask (bool): tile_maskが立っているセルだけを更新するかどうか
+        """
+        x0, y0 = cx * chunk_size, cy * chunk_size
+        x1, y1 = min(x0 + chunk_size, self.width), min(y0 + chunk_size, self.height)
+        ids = self.ids
+        if use_mask:
+            for x, y in zip(*np.nonzero(self.tile_mask[x0:x1, y0:y1])):
+                if ids[x0+x, y0+y] != 0:
+                    self.update_cell(x0+x, y0+y)
+            return
+        for x in range(x0, x1):
+            if not ids[x, y0:y1].any():
+                continue
+            for y in range(y0, y1):
+                if ids[x, y] != 0:
+                    self.update_cell(x, y)
+
+    def side_free(self, prio):
+        """
+        各セルについて、左右に自分より小さいmove_priorityのブロックがあるかどうかを返します。
+
+        Parameters:
+            prio (numpy.ndarray): 各セルのmove_priority
+        Returns:
+            tuple: (右が空いているか, 左が空いているか) のboolの配列
+        """
+        right_free = np.zeros(prio.shape, dtype=bool)
+        right_free[:-1] = prio[1:] < prio[:-1]
+        left_free = np.zeros(prio.shape, dtype=bool)
+        left_free[1:] = prio[:-1] < prio[1:]
+        return right_free, left_free
+
+    def batch_move(self, sources, dx:int, dy:int, prio, processed, x0:int = 0, y0:int = 0) -> int:
+        """
+        sourcesで指定された全てのブロックを、dx, dyだけまとめて動かします。
+        移動先が範囲外、処理済み、または自分以上のmove_priorityを持つ場合は動かしません。
+
+        Parameters:
+            sources (numpy.ndarray): 動かすブロックを表すboolの配列
+            dx (int): x方向の移動量
+            dy (int): y方向の移動量
+            prio (numpy.ndarray): 各セルのmove_priority (交換に合わせて更新されます)
+            processed (numpy.ndarray): 各セルが処理済みかどうか (交換に合わせて更新されます)
+            x0 (int): sources, prio, processedの左上のx座標
+            y0 (int): sources, prio, processedの左上のy座標
+        Returns:
+            int: 動かしたブロックの数
+        """
+        w, h = sources.shape
+        xs = np.flatnonzero(sources)
+        if dy == 1:
+            xs = xs[xs % h != h-1]
+        if dx == 1:
+            xs = xs[xs < (w-1) * h]
+        elif dx == -1:
+            xs = xs[xs >= h]
+        ts = xs + dx*h + dy
+        prio, processed = prio.ravel(), processed.ravel()
+        can_move = ~processed[xs] & ~processed[ts] & (prio[ts] < prio[xs])
+        xs, ts = xs[can_move], ts[can_move]
+        prio[xs], prio[ts] = prio[ts], prio[xs]
+        processed[xs] = True
+        processed[ts] = True
+
+        sx, sy = xs // h + x0, xs % h + y0
+        tx, ty = sx + dx, sy + dy
+        for array in self.cell_arrays:
+            array[sx, sy], array[tx, ty] = array[tx, ty], array[sx, sy]
+        self.last_tick[sx, sy] = self.tick_10
+        self.last_tick[tx, ty] = self.tick_10
+        self.chunk_changed[sx // chunk_size, sy // chunk_size] = True
+        self.chunk_changed[tx // chunk_size, ty // chunk_size] = True
+        return len(xs)
+
+    def resolve_explosions(self):
+        """
+        このtickに起きた爆発(detonations)を、まとめてワールドに反映します。
+
+        爆発ごとに、中心からのマンハッタン距離がblast_radius以内のセル(中心を除く)を影響範囲とし、
+        blast_powerに中心からそのセルまでの経路の数(blast_paths)を掛けた損傷を加えます。
+        中心の近くほど多くの経路が重なるため、1ブロックずつimpactを広げていた頃と同じだけ壊れます。
+        速度は一番近い爆発の中心から外向きに、大きさblast_powerで与えます。
+        耐久値が0以下になったブロックはtransform_toに変わります。
+        """
+        if not self.detonations:
+            return
+        if self.stats is not None:
+            start = time.perf_counter()
+        blasts = np.array(self.detonations, dtype=np.float64)
+        self.detonations = []
+        radius = int(blasts[:, 3].max())
+        offsets = np.array(
+            [(dx, dy) for dx in range(-radius, radius+1) for dy in range(-radius, radius+1) if 0 < abs(dx) + abs(dy) <= radius]
+        )
+        distance = np.abs(offsets).sum(axis=1)
+        which, offset = np.nonzero(distance[None, :] <= blasts[:, 3:4])
+        dx, dy = offsets[offset, 0], offsets[offset, 1]
+        xs = blasts[which, 0].astype(np.int64) + dx
+        ys = blasts[which, 1].astype(np.int64) + dy
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        which, offset, dx, dy, xs, ys = which[inside], offset[inside], dx[inside], dy[inside], xs[inside], ys[inside]
+        power = blasts[which, 2]
+        radii = blasts[which, 3].astype(np.int64)
+        paths = np.empty(len(which))
+        for r in np.unique(radii).tolist():
+            group = radii == r
+            paths[group] = blast_paths(r)[dx[group] + r, dy[group] + r]
+
+        np.subtract.at(self.durability, (xs, ys), (power * paths).astype(np.float32))
+        nearest = np.argsort(-distance[offset], kind="stable")
+        xs, ys, dx, dy, power = xs[nearest], ys[nearest], dx[nearest], dy[nearest], power[nearest]
+        length = np.hypot(dx, dy)
+        self.vx[xs, ys] = dx * power / length
+        self.vy[xs, ys] = dy * power / length
+        self.chunk_changed[xs // chunk_size, ys // chunk_size] = True
+
+        target = self.transform_to_table[self.ids[xs, ys]]
+        broken = (self.durability[xs, ys] <= 0) & (target >= 0)
+        self.transform[xs[broken], ys[broken]] = target[broken]
+        if self.stats is not None:
+            self.stats.add("explosion", time.perf_counter() - start)
+            self.stats.count("detonation", len(blasts))
+
+    def propagate_heat(self):
+        """
+        このtickに燃えていたブロック(heat_sources)の隣にある、燃えるブロックだけを温めます。
+
+        温めたブロックのburn_levelがburn_thresholdに達した場合は、fire_chanceの確率で火に、
+        それ以外は空気に変わるよう、まとめてtransformを設定します。
+        処理するのは火とその隣のセルだけなので、燃えている範囲の大きさに比例した時間で済みます。
+        """
+        if not self.heat_sources:
+            return
+        if self.stats is not None:
+            start = time.perf_counter()
+        sources = np.array(self.heat_sources, dtype=np.int64)
+        self.heat_sources = []
+        xs = (sources[:, 0:1] + np.array([0, 1, 0, -1])).ravel()
+        ys = (sources[:, 1:2] + np.array([1, 0, -1, 0])).ravel()
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys = xs[inside], ys[inside]
+        burnable = self.burn_threshold_table[self.ids[xs, ys]] < np.iinfo(np.int16).max
+        xs, ys = xs[burnable], ys[burnable]
+        if len(xs) == 0:
+            return
+        np.add.at(self.burn_level, (xs, ys), 1)
+        self.chunk_changed[xs // chunk_size, ys // chunk_size] = True
+
+        xs, ys = np.divmod(np.unique(xs * self.height + ys), self.height)
+        ids = self.ids[xs, ys]
+        ready = (self.burn_level[xs, ys] >= self.burn_threshold_table[ids]) & (self.transform[xs, ys] < 0)
+        xs, ys, ids = xs[ready], ys[ready], ids[ready]
+        roll = self.random_cells(xs, ys, stream_ignite)
+        self.transform[xs, ys] = np.where(roll < self.fire_chance_table[ids], Fire.id, 0)
+        if self.stats is not None:
+            self.stats.add("heat", time.perf_counter() - start)
+            self.stats.count("heat_source", len(sources))
+
+    def propagate_electric(self, x:int, y:int, level:int):
+        """
+        x, y座標から電気を流します。
+        隣に流れるたびにlevelが1ずつ下がり、電気を通すブロックのelectric_levelを高い方に更新します。
+
+        キューを使った幅優先探索で、どのセルにも最初に届いた時が一番高いlevelになるため、
+        electric_levelが既にlevel以上のセル(訪問済みのセル)は二度と処理しません。
+
+        Parameters:
+            x (int): 電気を流し始めるx座標
+            y (int): 電気を流し始めるy座標
+            level (int): 流し始める電気の強さ
+        """
+        frontier = collections.deque([(x, y, level)])
+        while frontier:
+            x, y, level = frontier.popleft()
+            if level <= 0 or not self.can_electric_table[self.ids[x, y]] or self.electric_level[x, y] >= level:
+                continue
+            self.electric_level[x, y] = level
+            self.wake(x, y)
+            for dx, dy in next_offsets:
+                nx, ny = x+dx, y+dy
+                if 0 <= nx < self.width and 0 <= ny < self.height:
+                    frontier.append((nx, ny, level-1))
+
+    def get_next_blocks(self, x:int, y:int) -> tuple:
+        """
+        x, y座標のブロックの隣り合う4ブロックの座標を取得します。
+        更新のたびに呼ぶ処理では使わず、隣を調べるブロックが next_offsets を直接使います。
+
+        Returns:
+            tuple: [上, 右, 下, 左]の順序(next_offsetsの順番)で、隣り合うブロックの(x, y)座標
+                   ワールドの範囲外の場合はNoneが入ります
+        """
+        if self.stats is not None:
+            self.stats.count("get_next_blocks")
+        w, h = self.width, self.height
+        return tuple((x+dx, y+dy) if 0 <= x+dx < w and 0 <= y+dy < h else None for dx, dy in next_offsets)
+
+    def export_world(self):
+        """
+        ワールドの状態をエクスポートします。
+
+        Returns:
+            list: エクスポートされたワールドの状態
+        """
+        export_data = self.copy_data(0, 0, self.width, self.height)
+        return export_data
+
+    def import_world(self, data:list):
+        """
+        インポートされたワールドの状態を、現在のワールドに適用します。
+
+        Parameters:
+            data (list): インポートされたワールドの状態
+        """
+        self.load_ids(data)
+
+    def snapshot(self, state:bool = True, copy:bool = True) -> dict:
+        """
+        保存するためのワールドの状態を、tickの区切りで取り出します。
+
+        Parameters:
+            state (bool): ブロックidだけでなく、速度や燃焼度などのセルの状態と色のノイズも含めるかどうか
+            copy (bool): 配列をコピーするかどうか (Falseなら書き終わるまでワールドを更新しないでください)
+        Returns:
+            dict: write_save()に渡す状態
+        """
+        names = self.save_array_names if state else ["ids"]
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tick": self.tick,
+            "seed": self.seed,
+            "arrays": {name: getattr(self, name).copy() if copy else getattr(self, name) for name in names},
+        }
+
+    def save_world(self, path:str, state:bool = True):
+        """
+        ワールドをファイルに保存します。
+        配列はコピーせずに少しずつ書き出すため、書き終わるまで戻りません。
+
+        Parameters:
+            path (str): 保存先のファイル名
+            state (bool): セルの状態も保存するかどうか
+        """
+        write_save(path, self.snapshot(state, copy=False))
+
+    def save_world_async(self, path:str, state:bool = True) -> threading.Thread:
+        """
+        今のtickの状態をコピーし、別スレッドでファイルに書き出します。
+        コピーはセルあたり数十バイトのmemcpyだけなので、フレームを止めません。
+
+        Parameters:
+            path (str): 保存先のファイル名
+            state (bool): セルの状態も保存するかどうか
+        Returns:
+            threading.Thread: 書き出しているスレッド
+        """
+        thread = threading.Thread(target=write_save, args=(path, self.snapshot(state)), daemon=True)
+        thread.start()
+        return thread
+
+    def restore_world(self, path:str, use_mmap:bool = True):
+        """
+        save_world()で保存したファイルのセルの状態を、同じ大きさのこのワールドに読み込みます。
+        tickとシードは変えません。
+
+        保存時とブロックのidが違っても、名前で今のidに読み替えます。知らないブロックはAirになります。
+        並列処理のプロセスを使っていない場合、保存された配列はメモリマップのままワールドの配列になります。
+        np.memmapのままだと1セルずつの添字が遅くなるため、np.ndarrayとしてのビューにして使います。
+
+        Parameters:
+            path (str): 読み込むファイル名
+            use_mmap (bool): 配列をメモリマップで開くかどうか
+        """
+        header, materials, arrays = read_save(path, use_mmap)
+        if (header["width"], header["height"]) != (self.width, self.height):
+            raise ValueError(f"{path} is {header['width']}x{header['height']}, world is {self.width}x{self.height}")
+        names = {block.__name__: id for id, block in block_types.items()}
+        remap = np.arange(256, dtype=np.uint8)
+        for id, name in materials.items():
+            remap[id] = names.get(name, 0)
+        ids = arrays.pop("ids")
+        if not all(remap[id] == id for id in materials):
+            ids = remap[ids]
+            if "transform" in arrays:
+                transform = arrays["transform"]
+                arrays["transform"] = np.where(transform >= 0, remap[np.clip(transform, 0, max_block_id)], -1)
+        if not all(name in arrays for name in self.save_array_names if name != "ids"):
+            self.load_ids(ids)
+            return
+        for name, array in [("ids", ids)] + list(arrays.items()):
+            if name not in self.save_array_names:
+                continue
+            array = array.astype(getattr(self, name).dtype, copy=False)
+            if self.pool is None:
+                setattr(self, name, array.view(np.ndarray))
+            else:
+                getattr(self, name)[:] = array
+        self.cell_arrays = [getattr(self, name) for name in self.cell_array_names]
+        self.chunk_changed.fill(True)
+        self.chunk_awake.fill(True)
+        self.chunk_idle.fill(0)
+        if self.renderer is not None:
+            self.renderer.drawn_ids = None
+
+    @classmethod
+    def load_world(cls, path:str, batched:bool = False, seed:int = None, workers:int = 0, use_mmap:bool = True):
+        """
+        save_world()で保存したファイルから、同じ大きさのワールドを作ります。
+        以前の形式(ブロックidだけの.npyファイル)も読み込めます。
+
+        Parameters:
+            path (str): 読み込むファイル名
+            batched (bool): 砂や液体の移動をNumPyでまとめて処理するかどうか
+            seed (int): 乱数のシード (Noneなら保存されたシードを使います)
+            workers (int): チャンクを並列に更新するプロセス数
+            use_mmap (bool): 配列をメモリマップで開くかどうか
+        Returns:
+            World: 読み込んだワールド
+        """
+        with open(path, "rb") as f:
+            magic = f.read(len(save_magic))
+        if magic != save_magic:
+            ids = np.load(path)
+            world = cls(ids.shape[0], ids.shape[1], batched, seed, workers)
+            world.load_ids(ids)
+            return world
+        header = read_save(path, use_mmap=True)[0]
+        world = cls(header["width"], header["height"], batched, header["seed"] if seed is None else seed, workers)
+        world.tick = header["tick"]
+        world.tick_10 = world.tick % 10
+        world.restore_world(path, use_mmap)
+        return world
+
+    def copy_data(self, x:int, y:int, wx:int, wy:int) -> list:
+        """
+        x, y座標のワールドの状態を、wx, wyの大きさでコピーします。
+        ワールドの範囲外の部分は0(Air)になります。
+
+        Parameters:
+            x (int): コピーするワールドの左上のx座標
+            y (int): コピーするワールドの左上のy座標
+            wx (int): コピーするワールドの幅
+            wy (int): コピーするワールドの高さ
+        Returns:
+            list: コピーされたワールドの状態
+        """
+        data = np.zeros((wx, wy), dtype=np.uint8)
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x+wx, self.width), min(y+wy, self.height)
+        if x1 < x2 and y1 < y2:
+            data[x1-x:x2-x, y1-y:y2-y] = self.ids[x1:x2, y1:y2]
+        return data.tolist()
+
+    def paste_data(self, x:int, y:int, data:list):
+        """
+        dataに格納されたワールドの状態を、x, y座標に貼り付けます。
+
+        Parameters:
+            x (int): 貼り付けるワールドの左上のx座標
+            y (int): 貼り付けるワールドの左上のy座標
+            data (list): 貼り付けるワールドの状態
+        """
+        paste_size_x = len(data)
+        paste_size_y = len(data[0])
+        start_x, start_y = x - paste_size_x//2, y - paste_size_y//2
+        for x2 in range(len(data)):
+            for y2 in range(len(data[x2])):
+                if data[x2][y2] != 0:
+                    self.set_block(start_x+x2, start_y+y2, data[x2][y2])
+
+
+command_sync_world = 1
+command_delta = 2
+command_set_blocks = 3
+command_viewport = 4
+command_hello = 5
+frame_header = struct.Struct("<BI")
+region_header = struct.Struct("<IIII")
+correction_header = struct.Struct("<II")
+send_queue_limit = 32
+receive_buffer_size = 1 << 16
+viewport_margin = 1
+max_predict_ticks = 8
+
+
+def encode_frame(command:int, payload:bytes) -> bytes:
+    """
+    コマンドとデータを、長さ付きのバイナリフレームにします。
+
+    Parameters:
+        command (int): コマンドの番号 (command_*)
+        payload (bytes): コマンドに渡すデータ
+    Returns:
+        bytes: 1バイトのコマンド、4バイトのデータ長、データの順に並べたフレーム
+    """
+    return frame_header.pack(command, len(payload)) + payload
+
+
+def encode_snapshot(ids, x:int = 0, y:int = 0) -> bytes:
+    """
+    x, y座標を左上とする範囲のブロックidを、位置と大きさ付きのzlib圧縮したバイト列にします。
+    ほとんどがAirのワールドは、1セル1バイトより大幅に小さくなります。
+
+    Parameters:
+        ids (numpy.ndarray): (幅, 高さ)の形をしたブロックidの配列
+        x (int): 範囲の左上のx座標
+        y (int): 範囲の左上のy座標
+    Returns:
+        bytes: 位置、幅、高さ、圧縮したidの順に並べたデータ
+    """
+    w, h = ids.shape
+    return region_header.pack(x, y, w, h) + zlib.compress(np.ascontiguousarray(ids, dtype=np.uint8).tobytes(), 1)
+
+
+def decode_snapshot(payload) -> tuple:
+    """
+    encode_snapshot()で作ったデータを、ブロックidの配列に戻します。
+
+    Parameters:
+        payload (bytes): encode_snapshot()で作ったデータ
+    Returns:
+        tuple: (左上のx座標, 左上のy座標, (幅, 高さ)の形をしたブロックidの配列)
+    """
+    x, y, w, h = region_header.unpack_from(payload)
+    data = zlib.decompress(memoryview(payload)[region_header.size:])
+    return x, y, np.frombuffer(data, dtype=np.uint8, count=w*h).reshape(w, h)
+
+
+def encode_delta(changed, ids, x:int = 0, y:int = 0) -> bytes:
+    """
+    x, y座標を左上とする範囲で変化したセルのidを、
+    (位置, id)の組のリストか、変化したセルのビットマスクの小さい方で符号化します。
+
+    Parameters:
+        changed (numpy.ndarray): 範囲内で変化したセルを表すboolの配列
+        ids (numpy.ndarray): changedと同じ形をした、現在のブロックidの配列
+        x (int): 範囲の左上のx座標
+        y (int): 範囲の左上のy座標
+    Returns:
+        bytes: 符号化した差分
+    """
+    header = region_header.pack(x, y, *changed.shape)
+    changed = changed.ravel()
+    indices = np.flatnonzero(changed).astype("<u4")
+    values = ids.ravel()[indices]
+    if len(indices) * 4 <= (len(changed) + 7) // 8:
+        return header + struct.pack("<BI", 0, len(indices)) + indices.tobytes() + values.tobytes()
+    return header + struct.pack("<BI", 1, len(changed)) + np.packbits(changed).tobytes() + values.tobytes()
+
+
+def decode_delta(payload, height:int) -> tuple:
+    """
+    encode_delta()で符号化した差分を元に戻します。
+
+    Parameters:
+        payload (bytes): 符号化した差分
+        height (int): ワールドの高さ
+    Returns:
+        tuple: (変化したセルのワールド全体での位置の配列, そのセルのidの配列)
+    """
+    x, y, w, h = region_header.unpack_from(payload)
+    offset = region_header.size
+    encoding, n = struct.unpack_from("<BI", payload, offset)
+    offset += struct.calcsize("<BI")
+    if encoding == 0:
+        indices = np.frombuffer(payload, dtype="<u4", count=n, offset=offset)
+        values = np.frombuffer(payload, dtype=np.uint8, count=n, offset=offset + n*4)
+    else:
+        mask_size = (n + 7) // 8
+        mask = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, count=mask_size, offset=offset), count=n)
+        indices = np.flatnonzero(mask)
+        values = np.frombuffer(payload, dtype=np.uint8, count=len(indices), offset=offset + mask_size)
+    indices = indices.astype(np.int64)
+    indices = (x + indices // h) * height + y + indices % h
+    return indices, values
+
+
+def area_difference(area:tuple, other:tuple) -> list:
+    """
+    (x0, y0, x1, y1)の範囲areaのうち、otherに含まれない部分を最大4つの長方形に分けて返します。
+
+    Parameters:
+        area (tuple): 元の範囲
+        other (tuple): 取り除く範囲
+    Returns:
+        list: (x0, y0, x1, y1)のリスト
+    """
+    x0, y0, x1, y1 = area
+    ox0, oy0, ox1, oy1 = other
+    if x0 >= x1 or y0 >= y1:
+        return []
+    if ox0 >= x1 or ox1 <= x0 or oy0 >= y1 or oy1 <= y0 or ox0 >= ox1 or oy0 >= oy1:
+        return [area]
+    parts = [
+        (x0, y0, ox0, y1),
+        (ox1, y0, x1, y1),
+        (max(x0, ox0), y0, min(x1, ox1), oy0),
+        (max(x0, ox0), oy1, min(x1, ox1), y1),
+    ]
+    return [(a, b, c, d) for a, b, c, d in parts if a < c and b < d]
+
+
+class MultiPlayer(World):
+    def __init__(self, w:int, h:int, isHost:bool, port:int, address:str, batched:bool = False,
+                 viewport:tuple = None, predict:bool = False, send_interval:int = 1):
+        """
+        マルチプレイヤーワールドを初期化します。
+
+        ホストはtickごとに、前回送信した時からidが変わったセルをまとめて1つのフレームにして
+        各クライアントに1回だけ送信します。
+        送るのはクライアントが登録したviewportと重なるチャンク(周りにviewport_marginチャンク分の余白を含む)の中だけで、
+        新しく見えるようになったチャンクはその範囲のワールドをまとめて送ります。
+        クライアントは自分が置いたブロックをためておき、tickごとに1つのフレームにしてホストに送信します。
+
+        差分とワールドのフレームには、ホストのtick番号と、反映済みのクライアントの操作の番号が付きます。
+        predictを有効にしたクライアントは自分でもワールドを更新して先の状態を表示し、
+        ホストから届いたtickの状態が予測と違った場合は、そのtickまで戻って
+        まだ反映されていない自分の操作を加えながら現在のtickまで更新し直します。
+
+        通信は専用のスレッドで動くasyncioのイベントループがまとめて行います。
+        受信したフレームはinboxにためておき、step()の最初にシミュレーションのスレッドで反映するため、
+        ワールドの配列を変更するのは常にシミュレーションのスレッドだけです。
+
+        Parameters:
+            w (int): ワールドの幅
+            h (int): ワールドの高さ
+            isHost (bool): サーバー役かどうか
+            port (int): ポート番号
+            address (str): IPアドレス
+            batched (bool): 砂や液体の移動をNumPyでまとめて処理するかどうか
+            viewport (tuple): クライアントの場合、最初に登録する(x, y, 幅, 高さ)の範囲 (Noneならワールド全体)
+            predict (bool): クライアントの場合、自分でもワールドを更新して予測するかどうか
+            send_interval (int): ホストの場合、差分を送信する間隔のtick数
+        """
+        super().__init__(w, h, batched)
+        self.address = address
+        self.port = port
+        self.lock = threading.RLock()
+        self.pending_sets = []
+        self.inbox = collections.deque()
+        self.predict = predict
+        self.send_interval = send_interval
+        self.simulating = False
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        try:
+            if isHost:
+                self.isHost = True
+                self.clients = []
+                self.sent_ids = self.ids.copy()
+                self.sent_tick = 0
+                self.multiplayer_server()
+            else:
+                self.isHost = False
+                self.input_seq = 0
+                self.acked_seq = 0
+                self.unacked = collections.deque()
+                self.confirmed_ids = self.ids.copy()
+                self.correction_tick = None
+                self.confirmed_tick = 0
+                self.history = {}
+                self.multiplayer_client()
+                self.set_viewport(*(viewport or (0, 0, w, h)))
+        except:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            raise
+
+    def step(self):
+        """
+        ホストの場合は受信したフレームを反映してからワールドを1tick更新し、変化をクライアントに送信します。
+        クライアントの場合はためておいた操作をホストに送信してから受信したフレームを反映し、
+        predictが有効なら、ホストから届いた最新のtickよりmax_predict_ticks先までの範囲でワールドを1tick予測します。
+        """
+        if self.isHost:
+            self.receive_commands()
+            super().step()
+            self.send_changes()
+        else:
+            self.send_pending()
+            self.receive_commands()
+            if self.predict:
+                self.reconcile()
+                if self.tick < self.confirmed_tick + max_predict_ticks:
+                    self.simulate()
+
+    def simulate(self):
+        """
+        クライアントの予測として、ワールドを1tick更新して結果をhistoryに残します。
+        更新中のset_blockは自分の操作として送信しません。
+        """
+        self.simulating = True
+        try:
+            super().step()
+        finally:
+            self.simulating = False
+        self.history[self.tick] = {name: getattr(self, name).copy() for name in self.cell_array_names}
+        self.history.pop(self.tick - max_predict_ticks * 2, None)
+
+    def reconcile(self):
+        """
+        ホストから届いた最新のtickの状態と、そのtickの予測を比べます。
+        viewportの中が違っていれば、ホストの状態まで戻してから、
+        まだ反映されていない自分の操作を加えながら現在のtickまで更新し直します。
+
+        ホストから届くのはブロックidだけなので、戻す時はそのtickの予測の状態を使い、
+        idが違っていたセルだけをホストのidの初期状態にします。
+        そのため予測が正しくなるのはidについてだけで、速度や燃焼度などは予測のものが残ります。
+        """
+        if self.correction_tick is None:
+            return
+        tick, self.correction_tick = self.correction_tick, None
+        while self.unacked and self.unacked[0][0] <= self.acked_seq:
+            self.unacked.popleft()
+        predicted = self.history.get(tick)
+        x0, y0, x1, y1 = self.interest
+        if predicted is not None and np.array_equal(predicted["ids"][x0:x1, y0:y1], self.confirmed_ids[x0:x1, y0:y1]):
+            return
+
+        stats, self.stats = self.stats, None
+        start = time.perf_counter()
+        now = min(max(self.tick, tick), tick + max_predict_ticks)
+        self.tick = tick
+        self.tick_10 = tick % 10
+        if predicted is None:
+            self.load_ids(self.confirmed_ids)
+        else:
+            for name, array in predicted.items():
+                getattr(self, name)[:] = array
+            wrong = np.flatnonzero(predicted["ids"] != self.confirmed_ids)
+            self.set_cells(wrong, self.confirmed_ids.ravel()[wrong])
+            self.chunk_changed.fill(True)
+        self.history = {tick: {name: getattr(self, name).copy() for name in self.cell_array_names}}
+        inputs = iter(self.unacked)
+        next_input = next(inputs, None)
+        while True:
+            while next_input is not None and next_input[1] <= self.tick:
+                for index, id, mode in next_input[2]:
+                    World.set_block(self, index // self.height, index % self.height, id, mode)
+                next_input = next(inputs, None)
+            if self.tick >= now:
+                break
+            self.simulate()
+        self.stats = stats
+        if stats is not None:
+            stats.add("reconcile", time.perf_counter() - start)
+            stats.count("replay_tick", now - tick)
+
+    def set_block(self, x, y, id, mode = 1, isSelf = True):
+        """
+        ブロックを設定します。
+
+        Parameters:
+            x (int): 設定するブロックのx座標
+            y (int): 設定するブロックのy座標
+            id (int): 設定するブロックのid
+            mode (bool): 上書きするかどうか
+            isSelf (bool): 自分自身が行う操作かどうか
+        """
+        super().set_block(x, y, id, mode)
+        if isSelf and not self.isHost and not self.simulating and self.in_area(x, y):
+            self.pending_sets.append((x * self.height + y, id, mode))
+
+    def send_changes(self):
+        """
+        前回送信した時からidが変わったセルを、クライアントごとに見えている範囲だけ差分フレームにして送信します。
+        同じ範囲を見ているクライアントには、同じ差分を使い回します。
+        send_intervalが1より大きい場合は、その間隔のtickでだけ送信します。
+        """
+        if self.tick % self.send_interval:
+            return
+        with self.lock:
+            self.sent_tick = self.tick
+            changed = self.ids != self.sent_ids
+            if not changed.any():
+                return
+            self.sent_ids[changed] = self.ids[changed]
+            frames = {}
+            for client in list(self.clients):
+                area = client.interest
+                if area not in frames:
+                    x0, y0, x1, y1 = area
+                    area_changed = changed[x0:x1, y0:y1]
+                    frames[area] = None
+                    if area_changed.any():
+                        frames[area] = encode_delta(area_changed, self.ids[x0:x1, y0:y1], x0, y0)
+                if frames[area] is not None:
+                    header = correction_header.pack(self.tick, client.acked_seq)
+                    self.send(encode_frame(command_delta, header + frames[area]), client)
+
+    def set_viewport(self, x:int, y:int, w:int, h:int):
+        """
+        クライアントが見ている範囲をホストに登録します。
+        ホストからはこの範囲と重なるチャンクの変化だけが送られてきます。
+
+        Parameters:
+            x (int): 範囲の左上のx座標
+            y (int): 範囲の左上のy座標
+            w (int): 範囲の幅
+            h (int): 範囲の高さ
+        """
+        self.interest = self.interest_area(x, y, w, h)
+        self.send(encode_frame(command_viewport, struct.pack("<iiII", x, y, w, h)))
+
+    def interest_area(self, x:int, y:int, w:int, h:int) -> tuple:
+        """
+        x, y, w, hの範囲と重なるチャンクに、周りのviewport_marginチャンクを加えた範囲を返します。
+
+        Returns:
+            tuple: ワールドの範囲に収めた(x0, y0, x1, y1)
+        """
+        margin = viewport_margin * chunk_size
+        x0 = min(max((x - margin) // chunk_size * chunk_size, 0), self.width)
+        y0 = min(max((y - margin) // chunk_size * chunk_size, 0), self.height)
+        x1 = max(min(-(-(x + w + margin) // chunk_size) * chunk_size, self.width), x0)
+        y1 = max(min(-(-(y + h + margin) // chunk_size) * chunk_size, self.height), y0)
+        return x0, y0, x1, y1
+
+    def send_pending(self):
+        """
+        ためておいたset_blockを、操作の番号を付けた1つのフレームにしてホストに送信します。
+        ホストが反映したことを確認するまで、操作は予測のやり直しに使うためunackedに残します。
+        """
+        if not self.pending_sets:
+            return
+        self.input_seq += 1
+        self.unacked.append((self.input_seq, self.tick, self.pending_sets))
+        sets = np.array(self.pending_sets, dtype=np.uint32)
+        self.pending_sets = []
+        payload = struct.pack("<II", self.input_seq, len(sets)) + sets[:, 0].astype("<u4").tobytes()
+        payload += sets[:, 1].astype(np.uint8).tobytes() + sets[:, 2].astype(np.uint8).tobytes()
+        self.send(encode_frame(command_set_blocks, payload))
+
+    def receive_commands(self):
+        """
+        通信スレッドがinboxにためたフレームを、受信した順に全て実行します。
+        """
+        while self.inbox:
+            connection, command, payload = self.inbox.popleft()
+            try:
+                self.do_command(command, payload, connection)
+            except Exception as e:
+                print("Error in command", command, e)
+
+    def do_command(self, command:int, payload:bytes, connection = None):
+        """
+        指定されたコマンドを実行します.
+
+        Parameters:
+            command (int): 実行するコマンドの番号 (command_*)
+            payload (bytes): コマンドに渡すデータ
+            connection (Connection): フレームを受信した接続
+        """
+        if command == command_set_blocks:
+            self.apply_set_blocks(payload, connection)
+        elif command == command_delta:
+            self.apply_delta(payload)
+        elif command == command_sync_world:
+            self.sync_world(payload)
+        elif command == command_hello:
+            self.seed, = struct.unpack("<Q", payload)
+
+    def apply_set_blocks(self, payload, connection = None):
+        """
+        クライアントから送られてきたset_blockのフレームを、まとめてワールドに反映します。
+        送信元のクライアントは既に自分で置いたブロックを表示しているため、
+        ホストでの結果が違っても正しい状態が届くよう、対象のセルは次の差分で必ず送信します。
+
+        Parameters:
+            payload (bytes): send_pending()で作られたデータ
+            connection (Connection): 送信元のクライアント
+        """
+        seq, n = struct.unpack_from("<II", payload)
+        indices = np.frombuffer(payload, dtype="<u4", count=n, offset=8)
+        ids = np.frombuffer(payload, dtype=np.uint8, count=n, offset=8 + n*4)
+        modes = np.frombuffer(payload, dtype=np.uint8, count=n, offset=8 + n*5)
+        inside = indices < self.width * self.height
+        indices, ids, modes = indices[inside], ids[inside], modes[inside]
+        keep = (modes == 1) | (self.ids.ravel()[indices] == 0)
+        self.set_cells(indices[keep], ids[keep])
+        with self.lock:
+            self.sent_ids.ravel()[indices] = max_block_id + 1
+            if connection is not None:
+                connection.acked_seq = seq
+
+    def apply_delta(self, payload):
+        """
+        ホストから送られてきた差分フレームを、まとめてワールドに反映します。
+        predictが有効な場合は、ホストの状態としてconfirmed_idsに反映し、次のreconcile()で予測と比べます。
+
+        Parameters:
+            payload (bytes): tick番号などのヘッダーと、encode_delta()で符号化した差分
+        """
+        tick, acked_seq = correction_header.unpack_from(payload)
+        indices, values = decode_delta(memoryview(payload)[correction_header.size:], self.height)
+        if self.predict:
+            self.confirmed_ids.ravel()[indices] = values
+            self.correct(tick, acked_seq)
+        else:
+            self.set_cells(indices, values)
+
+    def correct(self, tick:int, acked_seq:int):
+        """
+        ホストから届いた状態のtick番号と、反映済みの操作の番号を記録します。
+
+        Parameters:
+            tick (int): ホストのtick番号
+            acked_seq (int): ホストが反映した自分の操作の番号
+        """
+        self.correction_tick = tick
+        self.confirmed_tick = tick
+        self.acked_seq = max(self.acked_seq, acked_seq)
+
+    def send(self, message:bytes, client = None):
+        """
+        ホストの場合はclient(Noneなら全てのクライアント)に、クライアントの場合はサーバーにmessageを送信します。
+        実際の送信は通信スレッドに任せるため、遅いクライアントがいてもすぐに戻ります。
+
+        Parameters:
+            message (bytes): 送信するデータ
+            client (Connection): 送信先のクライアント
+        """
+        if self.stats is not None:
+            start = time.perf_counter()
+        if client is not None:
+            self.loop.call_soon_threadsafe(client.send_frame, message)
+            peers = 1
+        elif self.isHost:
+            self.loop.call_soon_threadsafe(self.broadcast, message)
+            peers = len(self.clients)
+        else:
+            self.loop.call_soon_threadsafe(self.connection.send_frame, message)
+            peers = 1
+        if self.stats is not None:
+            self.stats.add("network", time.perf_counter() - start)
+            self.stats.count("network_message", peers)
+            self.stats.count("network_byte", len(message) * peers)
+
+    def broadcast(self, message:bytes):
+        """
+        通信スレッドで、全てのクライアントの送信キューにmessageを入れます。
+
+        Parameters:
+            message (bytes): 送信するデータ
+        """
+        for client in self.clients:
+            client.send_frame(message)
+
+    def snapshot_frame(self, area:tuple, acked_seq:int = 0) -> bytes:
+        """
+        最後に送信した差分までを反映したareaの範囲のワールドを、sync_worldのフレームにします。
+        新しく見えるようになった範囲や、送信が追いつかなくなったクライアントに送ります。
+
+        Parameters:
+            area (tuple): (x0, y0, x1, y1)の範囲
+            acked_seq (int): 送信先のクライアントの、反映済みの操作の番号
+        Returns:
+            bytes: sync_worldのフレーム
+        """
+        x0, y0, x1, y1 = area
+        with self.lock:
+            snapshot = self.sent_ids[x0:x1, y0:y1].copy()
+            header = correction_header.pack(self.sent_tick, acked_seq)
+        return encode_frame(command_sync_world, header + encode_snapshot(snapshot, x0, y0))
+
+    def sync_world(self, payload):
+        """
+        送られてきたワールドデータを受け取り、
+        ワールドデータを更新します。
+
+        Parameters:
+            payload (bytes): tick番号などのヘッダーと、encode_snapshot()で作ったデータ
+        """
+        tick, acked_seq = correction_header.unpack_from(payload)
+        x, y, ids = decode_snapshot(memoryview(payload)[correction_header.size:])
+        ids = ids[:max(self.width - x, 0), :max(self.height - y, 0)]
+        if not self.isHost and self.predict:
+            self.confirmed_ids[x:x+ids.shape[0], y:y+ids.shape[1]] = ids
+            self.correct(tick, acked_seq)
+        elif x == 0 and y == 0 and ids.shape == self.ids.shape:
+            self.load_ids(ids)
+        else:
+            xs = np.arange(x, x + ids.shape[0])[:, None]
+            ys = np.arange(y, y + ids.shape[1])[None, :]
+            self.set_cells((xs * self.height + ys).ravel(), ids.ravel())
+
+    def import_world(self, data:list):
+        """
+        インポートされたワールドの状態を適用します。
+        クライアントの場合は、ホストにも同じワールドを送信します。
+
+        Parameters:
+            data (list): インポートされたワールドの状態
+        """
+        super().import_world(data)
+        if not self.isHost:
+            self.send(encode_frame(command_sync_world, correction_header.pack(0, 0) + encode_snapshot(self.ids)))
+
+    def restore_world(self, path:str, use_mmap:bool = True):
+        """
+        save_world()で保存したファイルのセルの状態を読み込みます。
+        クライアントの場合は、import_world()と同じようにホストにも読み込んだワールドを送信します。
+
+        Parameters:
+            path (str): 読み込むファイル名
+            use_mmap (bool): 配列をメモリマップで開くかどうか
+        """
+        super().restore_world(path, use_mmap)
+        if not self.isHost:
+            self.send(encode_frame(command_sync_world, correction_header.pack(0, 0) + encode_snapshot(self.ids)))
+
+    def run(self, coroutine):
+        """
+        通信スレッドのイベントループでcoroutineを実行し、その結果を待ちます。
+
+        Parameters:
+            coroutine: 実行するコルーチン
+        Returns:
+            coroutineの戻り値
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def multiplayer_server(self):
+        """
+        マルチプレイヤーサーバーを開始し、クライアントからの接続を待機します。
+        接続が確立されると、新しいConnectionオブジェクトがクライアントリストに加わり、
+        viewportが登録されるとその範囲のワールドを送信します。
+        """
+        self.listener = self.run(self.loop.create_server(lambda: Connection(self, True), self.address, self.port))
+
+    def multiplayer_client(self):
+        """
+        マルチプレイヤークライアントを開始し、サーバーとの接続を確立します。
+        サーバーとの接続が確立されると、新しいConnectionオブジェクトを作成し
+        そのオブジェクトをconnectionに格納します。
+        """
+        _, self.connection = self.run(
+            self.loop.create_connection(lambda: Connection(self, False), self.address, self.port)
+        )
+
+    def close(self):
+        """
+        全ての接続を閉じ、通信スレッドを止めます。
+        """
+        def shutdown():
+            if self.isHost:
+                self.listener.close()
+                for client in self.clients:
+                    client.transport.close()
+            else:
+                self.connection.transport.close()
+            self.loop.call_soon(self.loop.stop)
+        self.loop.call_soon_threadsafe(shutdown)
+
+
+class Connection(asyncio.BufferedProtocol):
+    def __init__(self, world:MultiPlayer, isHostSide:bool = False):
+        """
+        Connectionオブジェクトを初期化します.
+        メソッドは全て通信スレッドのイベントループから呼ばれます。
+
+        送信バッファがいっぱいの間、ホスト側ではフレームをsend_queue_limit個までキューにためます。
+        それを超えたクライアントはキューを捨て、送信できるようになった時に最新のワールドをまとめて送ります。
+        受信には大きさreceive_buffer_sizeのバッファを使い回し、直接書き込ませます。
+        サーバー側ではinterestに、クライアントが見ている範囲(x0, y0, x1, y1)を持ちます。
+
+        Parameters:
+            world (MultiPlayer): マルチプレイヤーワールド
+            isHostSide (bool): サーバー側の接続かどうか
+        """
+        self.world = world
+        self.isHostSide = isHostSide
+        self.transport = None
+        self.addr = None
+        self.buffer = bytearray(receive_buffer_size)
+        self.start = 0
+        self.end = 0
+        self.frame = None
+        self.frame_command = 0
+        self.frame_filled = 0
+        self.queue = collections.deque()
+        self.paused = False
+        self.stale = False
+        self.interest = (0, 0, 0, 0)
+        self.acked_seq = 0
+
+    def connection_made(self, transport):
+        """
+        接続した時に呼ばれます。
+        サーバー側では、参加したクライアントに乱数のシードを送り、クライアントリストに加えます。
+        ワールドはviewportが登録された時に、その範囲だけ送信します。
+        """
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        if self.isHostSide:
+            transport.write(encode_frame(command_hello, struct.pack("<Q", self.world.seed)))
+            self.world.clients.append(self)
+
+    def connection_lost(self, exc):
+        """
+        接続が切れた時に呼ばれ、クライアントリストから取り除きます。
+        """
+        if self.isHostSide and self in self.world.clients:
+            self.world.clients.remove(self)
+
+    def send_frame(self, frame:bytes):
+        """
+        フレームを送信します。送信バッファがいっぱいの間はキューにためます。
+
+        Parameters:
+            frame (bytes): 送信するフレーム
+        """
+        if self.transport is None or self.transport.is_closing() or self.stale:
+            return
+        if not self.paused:
+            self.transport.write(frame)
+        elif self.isHostSide and len(self.queue) >= send_queue_limit:
+            self.queue.clear()
+            self.stale = True
+        else:
+            self.queue.append(frame)
+
+    def pause_writing(self):
+        """
+        送信バッファが上限を超えた時に呼ばれます。
+        """
+        self.paused = True
+
+    def resume_writing(self):
+        """
+        送信バッファが空いた時に呼ばれ、ためておいたフレームを送信します。
+        キューがあふれていた場合は、代わりに最新のワールドを送信します。
+        """
+        self.paused = False
+        if self.stale:
+            self.stale = False
+            self.transport.write(self.world.snapshot_frame(self.interest, self.acked_seq))
+        while self.queue and not self.paused:
+            self.transport.write(self.queue.popleft())
+
+    def get_buffer(self, sizehint:int):
+        """
+        受信したデータを書き込む場所を返します。
+        大きなフレームの受信中は、そのフレーム専用のバッファの残りに直接書き込ませます。
+        """
+        if self.frame is not None:
+            return memoryview(self.frame)[self.frame_filled:]
+        view = memoryview(self.buffer)
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > 0 and len(self.buffer) - self.end < len(self.buffer) // 2:
+            size = self.end - self.start
+            view[:size] = view[self.start:self.end]
+            self.start, self.end = 0, size
+        return view[self.end:]
+
+    def buffer_updated(self, nbytes:int):
+        """
+        get_buffer()で渡した場所にnbytesだけ書き込まれた時に呼ばれ、
+        揃ったフレームをまとめてワールドのinboxに入れます.
+
+        フレームは1バイトのコマンド番号と4バイトのデータ長に、データが続く形式です。
+        受信用のバッファは使い回し、フレームはバッファの中でそのまま区切ります。
+        バッファに収まらない大きなフレームは、専用のバッファに直接受信します。
+        """
+        frames = []
+        if self.frame is not None:
+            self.frame_filled += nbytes
+            if self.frame_filled < len(self.frame):
+                return
+            frames.append((self.frame_command, self.frame))
+            self.frame = None
+        else:
+            self.end += nbytes
+
+        buffer = self.buffer
+        while self.end - self.start >= frame_header.size:
+            command, length = frame_header.unpack_from(buffer, self.start)
+            begin = self.start + frame_header.size
+            if length > len(buffer) - frame_header.size:
+                received = self.end - begin
+                self.frame = bytearray(length)
+                self.frame[:received] = memoryview(buffer)[begin:self.end]
+                self.frame_command = command
+                self.frame_filled = received
+                self.start = self.end = 0
+                break
+            if self.end - begin < length:
+                break
+            frames.append((command, buffer[begin:begin+length]))
+            self.start = begin + length
+        if frames:
+            self.dispatch(frames)
+
+    def dispatch(self, frames:list):
+        """
+        受信したフレームのうち、viewportの登録はその場で処理し、
+        それ以外はまとめてワールドのinboxに入れます。
+
+        Parameters:
+            frames (list): (コマンドの番号, データ)のリスト
+        """
+        if self.isHostSide:
+            for command, payload in frames:
+                if command == command_viewport:
+                    self.set_viewport(*struct.unpack("<iiII", payload))
+            frames = [frame for frame in frames if frame[0] != command_viewport]
+        self.world.inbox.extend((self, command, payload) for command, payload in frames)
+
+    def set_viewport(self, x:int, y:int, w:int, h:int):
+        """
+        クライアントが見ている範囲を更新し、新しく見えるようになった範囲のワールドを送信します。
+        interestの更新と送信するワールドのコピーはロックの中で行うため、
+        シミュレーションのスレッドが送る差分と食い違うことはありません。
+
+        Parameters:
+            x (int): 範囲の左上のx座標
+            y (int): 範囲の左上のy座標
+            w (int): 範囲の幅
+            h (int): 範囲の高さ
+        """
+        area = self.world.interest_area(x, y, w, h)
+        with self.world.lock:
+            old, self.interest = self.interest, area
+            frames = [self.world.snapshot_frame(new, self.acked_seq) for new in area_difference(area, old)]
+        for frame in frames:
+            self.send_frame(frame)
+
+
+def tile_worker(specs:list, w:int, h:int, conn):
+    """
+    TilePoolのワーカープロセスで動く関数です。
+    共有メモリ上の配列を持つワールドを作り、送られてきたタイルを更新しては結果を返します。
+
+    Parameters:
+        specs (list): (属性名, 共有メモリの名前, 形, dtype)のリスト
+        w (int): ワールドの幅
+        h (int): ワールドの高さ
+        conn: メインプロセスとのパイプ
+    """
+    world = World(w, h)
+    memories = [shared_memory.SharedMemory(name=name) for _, name, _, _ in specs]
+    for (attr, _, shape, dtype), memory in zip(specs, memories):
+        setattr(world, attr, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+    world.cell_arrays = [getattr(world, attr) for attr in World.cell_array_names]
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        world.seed, world.tick, world.tick_10, use_mask, tiles = message
+        try:
+            for cx, cy in tiles:
+                world.update_tile(cx, cy, use_mask)
+            conn.send((None, world.heat_sources, world.detonations))
+        except Exception as e:
+            conn.send((repr(e), [], []))
+        world.heat_sources = []
+        world.detonations = []
+    del world
+    for memory in memories:
+        memory.close()
+
+
+class TilePool:
+    def __init__(self, world:World, workers:int):
+        """
+        タイルを複数のプロセスで並列に更新するワーカープールを初期化します。
+
+        worldのセルごとの配列とチャンクの配列を共有メモリに移し、
+        各ワーカープロセスは同じ共有メモリを見るワールドを持ちます。
+
+        Parameters:
+            world (World): 更新するワールド
+            workers (int): ワーカープロセスの数
+        """
+        self.world = world
+        self.memories = []
+        specs = []
+        for attr in World.cell_array_names + World.shared_array_names:
+            array = getattr(world, attr)
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            shared[...] = array
+            setattr(world, attr, shared)
+            self.memories.append(memory)
+            specs.append((attr, memory.name, array.shape, array.dtype.str))
+        world.cell_arrays = [getattr(world, attr) for attr in World.cell_array_names]
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        self.connections = []
+        self.processes = []
+        for _ in range(workers):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=tile_worker, args=(specs, world.width, world.height, child_conn), daemon=True)
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+        atexit.register(self.close)
+
+    def run(self, tiles:list, use_mask:bool):
+        """
+        同じフェーズのタイルをワーカーに分けて更新し、全て終わるまで待ちます。
+
+        Parameters:
+            tiles (list): (チャンクのx, チャンクのy)のリスト
+            use_mask (bool): world.tile_maskが立っているセルだけを更新するかどうか
+        """
+        world = self.world
+        busy = []
+        for i, conn in enumerate(self.connections):
+            part = tiles[i::len(self.connections)]
+            if part:
+                conn.send((world.seed, world.tick, world.tick_10, use_mask, part))
+                busy.append(conn)
+        for conn in busy:
+            error, heat_sources, detonations = conn.recv()
+            if error is not None:
+                raise RuntimeError(error)
+            world.heat_sources += heat_sources
+            world.detonations += detonations
+
+    def close(self):
+        """
+        ワーカープロセスを止め、共有メモリを解放します。
+        ワールドの配列は共有メモリから通常の配列にコピーし直します。
+        """
+        if not self.processes:
+            return
+        for conn in self.connections:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        world = self.world
+        for attr in World.cell_array_names + World.shared_array_names:
+            setattr(world, attr, getattr(world, attr).copy())
+        world.cell_arrays = [getattr(world, attr) for attr in World.cell_array_names]
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+
+
+class Autosave:
+    def __init__(self, world:World, prefix:str = "autosave", interval:int = 3600, keep:int = 3,
+                 state:bool = True, copy_budget:int = 64):
+        """
+        interval tickごとに、ワールドを別スレッドでファイルに保存する自動保存を初期化します。
+        world.autosaveに設定すると、World.step()の最後に毎回step()が呼ばれます。
+
+        ワールドの配列と同じ形の保存用バッファを持ち、前回コピーしてから変化したかもしれないチャンク
+        (起きていたチャンクと、変化が記録されたチャンク)だけをバッファにコピーし直します。
+        眠っているチャンクは保存の前からcopy_budget個ずつ少しずつコピーしておくため、
+        保存するtickに止まる時間は、その時に起きているチャンクのコピーだけになります。
+        ファイルへの書き出しはバッファから別スレッドで行い、書き出し中はバッファを書き換えません。
+
+        Parameters:
+            world (World): 保存するワールド
+            prefix (str): 保存先のファイル名の前半 ("{prefix}-{tick}.w2d" に保存します)
+            interval (int): 保存する間隔のtick数
+            keep (int): 残しておく自動保存のファイル数
+            state (bool): セルの状態も保存するかどうか
+            copy_budget (int): 保存のtick以外に、1tickでコピーしておく眠っているチャンクの数
+        """
+        self.world = world
+        self.prefix = prefix
+        self.interval = interval
+        self.keep = keep
+        self.names = World.save_array_names if state else ["ids"]
+        self.copy_budget = copy_budget
+        self.buffers = None
+        self.dirty = np.ones((world.chunk_w, world.chunk_h), dtype=bool)
+        self.last_save_tick = world.tick
+        self.last_pause = 0.0
+        self.thread = None
+        directory = os.path.dirname(prefix) or "."
+        base = os.path.basename(prefix) + "-"
+        saves = [os.path.join(directory, name) for name in os.listdir(directory)
+                 if name.startswith(base) and name.endswith(".w2d")]
+        self.saves = collections.deque(sorted(saves, key=os.path.getmtime))
+
+    def step(self):
+        """
+        tickの区切りで呼び、変化したチャンクを記録し、保存の時間になっていれば保存を始めます。
+        """
+        world = self.world
+        self.dirty |= world.chunk_awake | world.chunk_changed
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if self.buffers is None:
+            self.buffers = {name: np.empty_like(getattr(world, name)) for name in self.names}
+        if world.tick - self.last_save_tick >= self.interval:
+            self.save()
+            return
+        pending = np.flatnonzero(self.dirty & ~world.chunk_awake)[:self.copy_budget]
+        if len(pending):
+            mask = np.zeros_like(self.dirty)
+            mask.flat[pending] = True
+            self.copy_chunks(mask)
+
+    def copy_chunks(self, mask):
+        """
+        maskがTrueのチャンクを、ワールドの配列から保存用バッファにコピーします。
+        チャンクの列ごとに、続いているチャンクはまとめてコピーします。
+
+        Parameters:
+            mask (numpy.ndarray): (チャンクの横の数, チャンクの縦の数)の形をした真偽値の配列
+        """
+        world = self.world
+        arrays = [(self.buffers[name], getattr(world, name)) for name in self.names]
+        for cx in np.flatnonzero(mask.any(axis=1)):
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], mask[cx].view(np.int8), [0]))))
+            x0, x1 = cx * chunk_size, min((cx+1) * chunk_size, world.width)
+            for start, end in zip(edges[::2], edges[1::2]):
+                y0, y1 = start * chunk_size, min(end * chunk_size, world.height)
+                for buffer, array in arrays:
+                    buffer[x0:x1, y0:y1] = array[x0:x1, y0:y1]
+        self.dirty &= ~mask
+
+    def save(self) -> threading.Thread:
+        """
+        残りの変化したチャンクをバッファにコピーし、今のtickの状態を別スレッドで書き出します。
+
+        Returns:
+            threading.Thread: 書き出しているスレッド
+        """
+        world = self.world
+        start = time.perf_counter()
+        self.copy_chunks(self.dirty.copy())
+        snapshot = {"width": world.width, "height": world.height, "tick": world.tick, "seed": world.seed,
+                    "arrays": self.buffers}
+        self.last_pause = time.perf_counter() - start
+        self.last_save_tick = world.tick
+        path = f"{self.prefix}-{world.tick:010d}.w2d"
+        self.thread = threading.Thread(target=self.write, args=(path, snapshot), daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def write(self, path:str, snapshot:dict):
+        """
+        書き出し用のスレッドで、ファイルを書き出し、古い自動保存を消します。
+
+        Parameters:
+            path (str): 保存先のファイル名
+            snapshot (dict): write_save()に渡す状態
+        """
+        write_save(path, snapshot)
+        if path in self.saves:
+            self.saves.remove(path)
+        self.saves.append(path)
+        while len(self.saves) > self.keep:
+            old = self.saves.popleft()
+            if os.path.exists(old):
+                os.remove(old)
+
+    def close(self):
+        """
+        書き出し中の自動保存があれば、終わるまで待ちます。
+        """
+        if self.thread is not None:
+            self.thread.join()
+
+
+class ChunkStore:
+    def __init__(self, directory:str, cache_bytes:int = 32 << 20, generate = None):
+        """
+        ワールドの窓の外に出たチャンクを預かる保管場所を初期化します。
+
+        チャンクはまずメモリ上のLRUキャッシュに入り、合計がcache_bytesを超えると
+        古いものから directory/{cx}_{cy}.npz に書き出されてメモリから消えます。
+        ディスクへの書き出しと、これから窓に入りそうなチャンクの先読み(ディスクからの読み込みや生成)は
+        バックグラウンドのスレッドで行います。
+
+        Parameters:
+            directory (str): チャンクを書き出すディレクトリ
+            cache_bytes (int): メモリに置いておくチャンクの合計バイト数の上限
+            generate (callable): generate(cx, cy)で、まだ無いチャンクのブロックidの配列
+                                 ((chunk_size, chunk_size)の形) を返す関数 (Noneなら空気のチャンクにします)
+                                 先読みのスレッドからも呼ばれます
+        """
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.generate = generate
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.writing = {}
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def path(self, key:tuple) -> str:
+        return os.path.join(self.directory, f"{key[0]}_{key[1]}.npz")
+
+    def read(self, key:tuple) -> dict:
+        """
+        チャンクをディスクから読み込むか、生成します。
+
+        Parameters:
+            key (tuple): チャンクの座標 (cx, cy)
+        Returns:
+            dict: {配列の名前: numpy.ndarray} (まだ保存されていないチャンクは"ids"だけ)
+        """
+        path = self.path(key)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        if self.generate is not None:
+            return {"ids": np.asarray(self.generate(*key), dtype=np.uint8)}
+        return {"ids": np.zeros((chunk_size, chunk_size), dtype=np.uint8)}
+
+    def get(self, key:tuple) -> dict:
+        """
+        窓に入るチャンクの内容を取り出します。
+        キャッシュや書き出し待ちに無ければ、その場でディスクから読み込むか生成します。
+
+        Parameters:
+            key (tuple): チャンクの座標 (cx, cy)
+        Returns:
+            dict: {配列の名前: numpy.ndarray}
+        """
+        with self.lock:
+            arrays = self.cache.pop(key, None)
+            if arrays is not None:
+                self.cached_bytes -= sum(array.nbytes for array in arrays.values())
+                return arrays
+            arrays = self.writing.get(key)
+            if arrays is not None:
+                return arrays
+        return self.read(key)
+
+    def put(self, key:tuple, arrays:dict):
+        """
+        窓から出たチャンクを預かります。
+        キャッシュがcache_bytesを超えた分は、古いチャンクから書き出し待ちにします。
+
+        Parameters:
+            key (tuple): チャンクの座標 (cx, cy)
+            arrays (dict): {配列の名前: numpy.ndarray}
+        """
+        with self.lock:
+            self.store(key, arrays)
+
+    def store(self, key:tuple, arrays:dict):
+        old = self.cache.pop(key, None)
+        if old is not None:
+            self.cached_bytes -= sum(array.nbytes for array in old.values())
+        self.cache[key] = arrays
+        self.cached_bytes += sum(array.nbytes for array in arrays.values())
+        while self.cached_bytes > self.cache_bytes and self.cache:
+            old_key, old = self.cache.popitem(last=False)
+            self.cached_bytes -= sum(array.nbytes for array in old.values())
+            if "vx" in old:
+                self.writing[old_key] = old
+                self.tasks.put(("write", old_key, old))
+
+    def prefetch(self, keys:list):
+        """
+        これから窓に入りそうなチャンクを、バックグラウンドでキャッシュに読み込ませます。
+
+        Parameters:
+            keys (list): チャンクの座標 (cx, cy) のリスト
+        """
+        for key in keys:
+            self.tasks.put(("load", key, None))
+
+    def work(self):
+        """
+        書き出しと先読みを行う、バックグラウンドのスレッドの処理です。
+        """
+        while True:
+            task, key, arrays = self.tasks.get()
+            try:
+                if task == "write":
+                    temp_path = self.path(key) + ".tmp.npz"
+                    np.savez(temp_path, **arrays)
+                    os.replace(temp_path, self.path(key))
+                    with self.lock:
+                        if self.writing.get(key) is arrays:
+                            del self.writing[key]
+                elif task == "load":
+                    with self.lock:
+                        if key in self.cache or key in self.writing:
+                            continue
+                    arrays = self.read(key)
+                    with self.lock:
+                        if key not in self.cache and key not in self.writing:
+                            self.store(key, arrays)
+                elif task == "stop":
+                    return
+            finally:
+                self.tasks.task_done()
+
+    def flush(self):
+        """
+        キャッシュにある、状態を持つチャンクを全てディスクに書き出し、書き終わるまで待ちます。
+        """
+        with self.lock:
+            for key, arrays in self.cache.items():
+                if "vx" in arrays:
+                    self.writing[key] = arrays
+                    self.tasks.put(("write", key, arrays))
+        self.tasks.join()
+
+    def close(self):
+        """
+        書き出しを終わらせて、バックグラウンドのスレッドを止めます。
+        既に止めている場合は何もしません。
+        """
+        if self.thread is None:
+            return
+        self.flush()
+        self.tasks.put(("stop", None, None))
+        self.thread.join()
+        self.thread = None
+
+
+class StreamedWorld(World):
+    def __init__(self, w:int, h:int, directory:str = "world_chunks", cache_bytes:int = 32 << 20,
+                 generate = None, batched:bool = False, seed:int = None, margin:int = 1):
         """
+        座標に限りの無いワールドを、チャンク単位で出し入れしながら扱います。
 
-        self.blocks = [Air, Stone, Sand, Water, Fire, Wood, Oil, Gunpowder, Fuse, Iron, WoodDust]
-        self.width = w
-        self.height = h
-        self.data = [[Air() for _ in range(self.height)] for _ in range(self.width)]
-        self.randamize_color = [[random.randint(0, 30) for _ in range(self.height)] for _ in range(self.width)]
-        self.tick_10 = 0
+        Worldの配列は、カメラに映る幅w、高さhの範囲(view)を、周りにmarginチャンクずつ広げて
+        チャンクの大きさに切り上げた窓だけを持ちます。
+        配列の座標 x, y は窓の中の座標で、ワールド全体の座標は
+        (chunk_x*chunk_size + x, chunk_y*chunk_size + y) です。
+        画面の外でも窓の中にあるチャンクは更新され続けるので、カメラのすぐ外で動いている砂や火は止まりません。
+        窓から出たチャンクはChunkStoreに預け、更新は止まります。
+        メモリに置くのは窓とChunkStoreのキャッシュだけなので、どれだけ遠くまで動いても使用量は一定です。
+        directoryに前回のカメラの位置とtickが残っていれば、そこから続けます。
 
-    def in_area(self, x, y):        
-        """
-        指定されたx, y座標がワールドの範囲内にあるかどうかを返します。
-        
         Parameters:
-            x (int): x座標
-            y (int): y座標
-        Returns:
-            bool: ワールドの範囲内にあるかどうか
+            w (int): カメラに映す幅
+            h (int): カメラに映す高さ
+            directory (str): チャンクを書き出すディレクトリ
+            cache_bytes (int): メモリに置いておく窓の外のチャンクの合計バイト数の上限
+            generate (callable): まだ無いチャンクのブロックidを返す関数 (ChunkStoreを参照)
+            batched (bool): 砂や液体の移動をNumPyでまとめて処理するかどうか
+            seed (int): 乱数のシード (Noneなら前回のシードか、ランダムに決めます)
+            margin (int): カメラの外側で更新し続けるチャンクの幅
         """
-        if 0 <= x < self.width and 0 <= y < self.height:
-            return True
-        return False
-    
-    def is_can_move(self, x, y, mvx, mvy):
+        meta_path = os.path.join(directory, "world.npz")
+        meta = None
+        if os.path.exists(meta_path):
+            with np.load(meta_path) as data:
+                meta = {name: int(data[name]) for name in data.files}
+            if seed is None:
+                seed = meta["seed"]
+        self.margin = margin
+        self.chunk_x, self.chunk_y = -margin, -margin
+        pad = margin * chunk_size
+        super().__init__(-(-w // chunk_size) * chunk_size + 2*pad, -(-h // chunk_size) * chunk_size + 2*pad, batched, seed)
+        self.view = (pad, pad, pad + w, pad + h)
+        self.meta_path = meta_path
+        self.store = ChunkStore(directory, cache_bytes, generate)
+        if meta is not None:
+            self.chunk_x, self.chunk_y = meta["chunk_x"] - margin, meta["chunk_y"] - margin
+            self.tick = meta["tick"]
+            self.tick_10 = self.tick % 10
+        for cx in range(self.chunk_w):
+            for cy in range(self.chunk_h):
+                self.load_chunk(cx, cy)
+        self.prefetch_ring()
+
+    @property
+    def origin(self) -> tuple:
         """
-        指定されたx, y座標に mvx, mvy だけ動かす事が出来るかどうかを返します。
-        
-        Parameters:
-            x (int): x座標
-            y (int): y座標
-            mvx (int): x方向の移動量
-            mvy (int): y方向の移動量
-        Returns:
-            bool: 動かすことが出来るかどうか
+        窓の左上の、ワールド全体での座標を返します。
         """
-        inArea = self.in_area(x, y)
-        inArea2 = self.in_area(x+mvx, y+mvy)
-        if not inArea or not inArea2:
-            return False
-        isNotProcessed = self.data[x][y].last_tick != self.tick_10
-        isNotProcessed2 = self.data[x+mvx][y+mvy].last_tick != self.tick_10
-        mv2p = self.data[x+mvx][y+mvy].move_priority
-        myp = self.data[x][y].move_priority
-        if inArea and isNotProcessed and isNotProcessed2 and mv2p < myp:
-            return True
-        return False
-    
-    def swap_block(self, x1, y1, x2, y2):
+        return self.chunk_x * chunk_size, self.chunk_y * chunk_size
+
+    def random(self, x:int, y:int, stream:int = stream_move) -> float:
         """
-        x1, y1とx2, y2のブロックを交換します。
-        
-        Parameters:
-            x1 (int): 交換するブロック1のx座標
-            y1 (int): 交換するブロック1のy座標
-            x2 (int): 交換するブロック2のx座標
-            y2 (int): 交換するブロック2のy座標
+        窓の中のx, y座標で使う乱数を、ワールド全体での座標から計算します。
+        同じ場所は、窓がどこにあっても同じ乱数になります。
         """
-        self.data[x1][y1], self.data[x2][y2] = self.data[x2][y2], self.data[x1][y1]
-        self.data[x1][y1].last_tick = self.tick_10
-        self.data[x2][y2].last_tick = self.tick_10
+        cx, cy = self.origin
+        return super().random(cx + x, cy + y, stream)
 
-    def set_block(self, x:int, y:int, id:int ,mode:int = 1) -> None:
+    def random_area(self, x0:int, y0:int, x1:int, y1:int, stream:int = stream_move, tick:int = None):
         """
-        x, y座標にid番目のブロックを配置します。
-        modeが1の場合は、既にブロックが存在する場合でも強制的に置き換えます。
-        modeが0の場合は、既にブロックが存在する場合は何もしません。
+        窓の中の範囲の乱数を、ワールド全体での座標から計算します。
         """
-        
-        try:
-            block = self.blocks[id]
-        except:
-            block = Air
-        block.last_tick = self.tick_10
-        if self.in_area(x, y):
-            if mode == 1 or self.get_block_id(x, y) == 0:
-                self.data[x][y] = block()
+        cx, cy = self.origin
+        return super().random_area(cx + x0, cy + y0, cx + x1, cy + y1, stream, tick)
 
-    def get_block_id(self, x:int, y:int) -> int:
+    def random_cells(self, xs, ys, stream:int = stream_move):
         """
-        x, y座標のブロックのidを取得します。
-        
-        Parameters:
-            x (int): x座標
-            y (int): y座標
-        Returns:
-            int: ブロックのid
+        窓の中の各セルの乱数を、ワールド全体での座標から計算します。
         """
-        try:
-            id = self.blocks.index(self.data[x][y].__class__)
-        except:
-            id = 0
-        return id
+        cx, cy = self.origin
+        return super().random_cells(np.asarray(xs) + cx, np.asarray(ys) + cy, stream)
 
-    def randamize(self, x, y):
+    def chunk_slices(self, cx:int, cy:int) -> tuple:
+        return slice(cx*chunk_size, (cx+1)*chunk_size), slice(cy*chunk_size, (cy+1)*chunk_size)
+
+    def unload_chunk(self, cx:int, cy:int):
         """
-        x, y座標のブロックの色を、乱数に基づいてランダマイズします。
-        
-        Parameters:
-            x (int): x座標
-            y (int): y座標
-        Returns:
-            tuple: (r, g, b)形式の色
+        窓の中のcx, cy番目のチャンクをChunkStoreに預けます。
         """
-        base_color = self.data[x][y].color
-        random_color = self.randamize_color[x][y]
-        r = base_color[0] - random_color
-        g = base_color[1] - random_color
-        b = base_color[2] - random_color
-        if r < 0:
-            r = 0
-        if g < 0:
-            g = 0
-        if b < 0:
-            b = 0
-        processed_color = (r, g, b)
-        return processed_color
-    
+        area = self.chunk_slices(cx, cy)
+        arrays = {name: getattr(self, name)[area].copy() for name in self.save_array_names}
+        self.store.put((self.chunk_x + cx, self.chunk_y + cy), arrays)
 
-    def render(self, screen:pygame.Surface, x, y):
+    def load_chunk(self, cx:int, cy:int):
         """
-        x, y座標のブロックを描画します。
-
-        Parameters:
-            screen (pygame.Surface): 描画するSurface
-            x (int): x座標
-            y (int): y座標
+        ChunkStoreから取り出したチャンクを、窓の中のcx, cy番目に置きます。
+        ブロックidしか無いチャンク(生成したチャンク)は、load_ids()と同じ初期値で埋めます。
         """
-        if not self.data[x][y].invisible:
-            pygame.draw.rect(screen, self.randamize(x, y), (x*block_w, y*block_w, block_w, block_w), 0)
-    
-    def update(self, screen:pygame.Surface):
+        key = (self.chunk_x + cx, self.chunk_y + cy)
+        arrays = self.store.get(key)
+        area = self.chunk_slices(cx, cy)
+        if "vx" in arrays:
+            for name in self.save_array_names:
+                getattr(self, name)[area] = arrays[name]
+            return
+        ids = self.id_table[arrays["ids"]]
+        self.ids[area] = ids
+        self.vx[area] = 0
+        self.vy[area] = 0
+        self.burn_level[area] = 0
+        self.durability[area] = self.durability_table[ids]
+        self.electric_level[area] = 0
+        self.lifetime[area] = self.lifetime_table[ids]
+        self.last_tick[area] = self.tick_10
+        self.is_ground[area] = False
+        self.transform[area] = -1
+        x0, y0 = cx * chunk_size, cy * chunk_size
+        noise = self.random_area(x0, y0, x0 + chunk_size, y0 + chunk_size, stream_color, 0) * (color_noise+1)
+        self.randamize_color[area] = noise.astype(np.uint8)
+
+    def move_window(self, dx:int, dy:int):
         """
-        全てのブロックを更新し、描画します。
+        窓をdx, dyチャンクだけ動かします。
+        窓から出るチャンクをChunkStoreに預け、残るチャンクをずらし、入ってくるチャンクを読み込みます。
+        tickの区切りで呼んでください。
 
         Parameters:
-            screen (pygame.Surface): 描画するSurface
+            dx (int): x方向に動かすチャンク数
+            dy (int): y方向に動かすチャンク数
         """
-        
-        self.tick_10 = (self.tick_10 + 1) % 10
-        screen.fill((0, 0, 0))
-        for x in range(self.width):
-            for y in range(self.height):
-                block = self.data[x][y]
-                mvx, mvy = block.update()
-                isNotAir = not block.__class__ == Air
-                block.next_blocks = self.get_next_blocks(x, y)
-                if isNotAir:
-                    if block.dead:
-                        self.set_block(x, y, 0)
-                        continue
-                    if block.fire:
-                        r = random.random()
-                        if r < block.fire_chance:
-                            self.set_block(x, y, 4)
-                        else:
-                            self.set_block(x, y, 0)
-                    if block.transform is not None:
-                        self.set_block(x, y, self.blocks.index(block.transform))
-                    if self.in_area(x, y+1):
-                        if self.data[x][y+1].move_priority >= block.move_priority:
-                            block.isGround = True
-                        else:
-                            block.isGround = False
-                    else:
-                        block.isGround = True
-                    
-                    if self.is_can_move(x, y, mvx, mvy):
-                        self.swap_block(x, y, x+mvx, y+mvy)
-                        self.render(screen, x+mvx, y+mvy)
-                    else:
-                        if abs(mvx) > abs(mvy):
-                            block.vx *= 0.5
-                        else:
-                            block.vy *= 0.5
-                    self.render(screen, x, y)
+        if dx == 0 and dy == 0:
+            return
+        cw, ch = self.chunk_w, self.chunk_h
+        stay_x = range(max(dx, 0), min(cw + dx, cw))
+        stay_y = range(max(dy, 0), min(ch + dy, ch))
+        for cx in range(cw):
+            for cy in range(ch):
+                if cx not in stay_x or cy not in stay_y:
+                    self.unload_chunk(cx, cy)
+        shift = (-dx * chunk_size, -dy * chunk_size)
+        for name in self.save_array_names:
+            array = getattr(self, name)
+            array[:] = np.roll(array, shift, axis=(0, 1))
+        self.chunk_idle[:] = np.roll(self.chunk_idle, (-dx, -dy), axis=(0, 1))
+        self.chunk_x += dx
+        self.chunk_y += dy
+        for cx in range(cw):
+            for cy in range(ch):
+                if cx + dx not in stay_x or cy + dy not in stay_y:
+                    self.load_chunk(cx, cy)
+        self.chunk_changed.fill(True)
+        self.chunk_awake.fill(True)
+        if self.renderer is not None:
+            self.renderer.drawn_ids = None
+        self.prefetch_ring()
 
-    def get_next_blocks(self, x:int, y:int) -> list:
+    def prefetch_ring(self):
         """
-        x, y座標のブロックの隣り合う4ブロックを取得します。
-        
-        Returns:
-            list: [上, 右, 下, 左]の順序で、隣り合うブロックを格納したリスト
+        窓のすぐ外側を1チャンク分囲むチャンクを先読みさせます。
         """
-        next_blocks = [None, None, None, None]
-        x_list = [0, 1, 0, -1]
-        y_list = [1, 0, -1, 0]
-        for i in range(4):
-            if self.in_area(x+x_list[i], y+y_list[i]):
-                next_blocks[i] = self.data[x+x_list[i]][y+y_list[i]]
-        return next_blocks
+        cw, ch = self.chunk_w, self.chunk_h
+        keys = [(cx, cy) for cx in range(-1, cw + 1) for cy in range(-1, ch + 1)
+                if not (0 <= cx < cw and 0 <= cy < ch)]
+        self.store.prefetch([(self.chunk_x + cx, self.chunk_y + cy) for cx, cy in keys])
 
-    def export_world(self):
+    def close(self):
         """
-        ワールドの状態をエクスポートします。
-
-        Returns:
-            list: エクスポートされたワールドの状態
+        窓の中のチャンクも含めて全てディスクに書き出し、カメラの位置とtickを保存します。
+        既に閉じている場合は何もしません。
         """
-        export_data = self.copy_data(0, 0, self.width, self.height)
-        return export_data
-    
-    def import_world(self, data:list):
+        if self.store.thread is None:
+            return
+        for cx in range(self.chunk_w):
+            for cy in range(self.chunk_h):
+                self.unload_chunk(cx, cy)
+        self.store.close()
+        np.savez(self.meta_path, seed=self.seed, tick=self.tick,
+                 chunk_x=self.chunk_x + self.margin, chunk_y=self.chunk_y + self.margin)
+
+
+class Renderer:
+    def __init__(self, world:World):
         """
-        インポートされたワールドの状態を、現在のワールドに適用します。
-        
+        変化したセルだけを描き直すレンダラーを初期化します。
+
+        1セルを1ピクセルとしたcellsと、それをblock_w倍に拡大したsurfaceを保持し、
+        前回描画したブロックidと比べて変化したチャンクだけを拡大し直します。
+        cellsのピクセルがセルごとのRGBバッファになっており、
+        ブロックの種類が変わったセルだけをworld.display_lutから引き直します。
+        surfaceと画面に描くのはworld.viewの範囲だけで、画面の左上がviewの左上になります。
+
         Parameters:
-            data (list): インポートされたワールドの状態
+            world (World): 描画するワールド
         """
-        for x in range(self.width):
-            for y in range(self.height):
-                self.set_block(x, y, data[x][y])
+        self.world = world
+        x0, y0, x1, y1 = world.view
+        self.view = pygame.Rect(x0, y0, x1 - x0, y1 - y0)
+        self.cells = pygame.Surface((world.width, world.height))
+        self.surface = pygame.Surface((self.view.w*block_w, self.view.h*block_w))
+        self.drawn_ids = None
 
-    def copy_data(self, x:int, y:int, wx:int, wy:int) -> list:
+    def blit_grid(self):
         """
-        x, y座標のワールドの状態を、wx, wyの大きさでコピーします。
-        
+        ワールド全体のidをパレットで色に変換し、surfaceに一度に描画します。
+        """
+        world = self.world
+        pygame.surfarray.blit_array(self.cells, world.display_lut[world.ids, world.randamize_color])
+        pygame.transform.scale(self.cells.subsurface(self.view), self.surface.get_size(), self.surface)
+        self.drawn_ids = world.ids.copy()
+
+    def draw(self, screen:pygame.Surface) -> list:
+        """
+        前回の描画から変化したセルを含むチャンクだけを描き直し、screenに転送します。
+
         Parameters:
-            x (int): コピーするワールドの左上のx座標
-            y (int): コピーするワールドの左上のy座標
-            wx (int): コピーするワールドの幅
-            wy (int): コピーするワールドの高さ
+            screen (pygame.Surface): 描画するSurface
         Returns:
-            list: コピーされたワールドの状態
+            list: 描き直した範囲のpygame.Rectのリスト (pygame.display.updateにそのまま渡せます)
         """
-        data = [[0 for _ in range(wy)] for _ in range(wx)]
-        for x2 in range(wx):
-            for y2 in range(wy):
-                data[x2][y2] = self.get_block_id(x+x2, y+y2)
-        return data
+        world = self.world
+        if self.drawn_ids is None:
+            self.blit_grid()
+            return [screen.blit(self.surface, (0, 0))]
+        xs, ys = np.nonzero(world.ids != self.drawn_ids)
+        if len(xs) == 0:
+            return []
+        ids = world.ids[xs, ys]
+        pixels = pygame.surfarray.pixels3d(self.cells)
+        pixels[xs, ys] = world.display_lut[ids, world.randamize_color[xs, ys]]
+        del pixels
+        self.drawn_ids[xs, ys] = ids
 
-    def paste_data(self, x:int, y:int, data:list):
+        rects = []
+        view = self.view
+        for chunk in np.unique((xs // chunk_size) * world.chunk_h + ys // chunk_size):
+            cx, cy = divmod(int(chunk), world.chunk_h)
+            area = pygame.Rect(cx*chunk_size, cy*chunk_size, chunk_size, chunk_size).clip(view)
+            if area.w == 0 or area.h == 0:
+                continue
+            rect = pygame.Rect((area.x - view.x)*block_w, (area.y - view.y)*block_w, area.w*block_w, area.h*block_w)
+            pygame.transform.scale(self.cells.subsurface(area), rect.size, self.surface.subsurface(rect))
+            rects.append(screen.blit(self.surface, rect, rect))
+        return rects
+
+    def restore(self, screen:pygame.Surface, rects:list):
         """
-        dataに格納されたワールドの状態を、x, y座標に貼り付けます。
-        
+        screenのrectsの範囲を、ワールドの描画で上書きします。
+        カーソルやUIなど、ワールドの上に描いたものを消すのに使います。
+
         Parameters:
-            x (int): 貼り付けるワールドの左上のx座標
-            y (int): 貼り付けるワールドの左上のy座標
-            data (list): 貼り付けるワールドの状態
+            screen (pygame.Surface): 描画するSurface
+            rects (list): 上書きする範囲のpygame.Rectのリスト
         """
-        paste_size_x = len(data)
-        paste_size_y = len(data[0])
-        start_x, start_y = x - paste_size_x//2, y - paste_size_y//2 
-        for x2 in range(len(data)):
-            for y2 in range(len(data[x2])):
-                if data[x2][y2] != 0:
-                    self.set_block(start_x+x2, start_y+y2, data[x2][y2])
-    
-                    
-class MultiPlayer(World):
-    def __init__(self, w:int, h:int, isHost:bool, port:int, address:str):
+        for rect in rects:
+            screen.blit(self.surface, rect, rect)
+
+
+class Scheduler:
+    def __init__(self, tick_rate:float = 60, frame_rate:float = 60, max_steps:int = 5):
         """
-        マルチプレイヤーワールドを初期化します。
+        物理の更新(tick)を、描画のフレームレートとは独立した固定の間隔で行うためのスケジューラーを初期化します。
 
         Parameters:
-            w (int): ワールドの幅
-            h (int): ワールドの高さ
-            isHost (bool): サーバー役かどうか
-            port (int): ポート番号
-            address (str): IPアドレス
+            tick_rate (float): 1秒あたりのtick数
+            frame_rate (float): 1秒あたりの描画回数
+            max_steps (int): 1フレームで追いつくために実行するtickの上限
+                (1フレームの時間(1/frame_rate)を使い切った場合は、それより前に止めます)
         """
-        super().__init__(w, h)
-        self.address = address
-        self.port = port
-        if isHost:
-            self.isHost = True
-            self.clients = []
-            threading.Thread(target=self.multiplayer_server, daemon=True).start()
-        else:
-            self.isHost = False
-            self.multiplayer_client()
-    def update(self, screen:pygame.Surface):
-        if self.isHost:
-            super().update(screen)
+        self.tick_rate = tick_rate
+        self.frame_rate = frame_rate
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+        self.last_time = time.perf_counter()
+        self.dropped_ticks = 0
+
+    def due_ticks(self) -> int:
+        """
+        前回呼ばれてから経過した時間に対して、今実行するべきtick数を返します。
+        max_stepsを超えて遅れている分は捨て、遅れがたまり続けないようにします。
+
+        Returns:
+            int: 今実行するべきtick数
+        """
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        tick_time = 1 / self.tick_rate
+        steps = int(self.accumulator / tick_time)
+        if steps > self.max_steps:
+            self.dropped_ticks += steps - self.max_steps
+            steps = self.max_steps
+            self.accumulator = 0.0
         else:
-            screen.fill((0, 0, 0))
-            for x in range(self.width):
-                for y in range(self.height):
-                    block = self.data[x][y]
-                    if block.__class__ == Air:
-                        continue
-                    self.render(screen, x, y)
+            self.accumulator -= steps * tick_time
+        return steps
 
-    def set_block(self, x, y, id, mode = 1, isSelf = True):
+    def run_ticks(self, world:World) -> int:
         """
-        ブロックを設定します。
+        今実行するべきtick数だけworld.step()を呼びます。
+        1tickに1/tick_rateより長くかかる場合でも入力と描画が止まらないよう、
+        このフレームで1/frame_rateの時間を使い切ったら残りのtickは実行せずに捨てます。
 
         Parameters:
-            x (int): 設定するブロックのx座標
-            y (int): 設定するブロックのy座標
-            id (int): 設定するブロックのid
-            mode (bool): 上書きするかどうか
-            isSelf (bool): 自分自身が行う操作かどうか
+            world (World): 更新するワールド
+        Returns:
+            int: 実行したtick数
         """
-        super().set_block(x, y, id, mode)
-        if isSelf:
-            if self.isHost:
-                for client in self.clients:
-                    try:
-                        client.conn.send(f"set_block,{x},{y},{id},{mode};".encode("utf-8"))
-                    except:
-                        self.clients.remove(client)
-            else:
-                self.server.send(f"set_block,{x},{y},{id},{mode};".encode("utf-8"))
-    
-    def swap_block(self, x1, y1, x2, y2, isSelf = True):
+        steps = self.due_ticks()
+        start = time.perf_counter()
+        budget = 1 / self.frame_rate
+        for done in range(steps):
+            if done > 0 and time.perf_counter() - start >= budget:
+                self.dropped_ticks += steps - done
+                return done
+            world.step()
+        return steps
+
+
+class TickStats:
+    def __init__(self, history:int = 120):
         """
-        ブロックを交換します。
+        tickごとの処理時間と回数を記録する統計オブジェクトを初期化します。
+        world.statsに設定した時だけ記録され、Noneの場合は計測のコストはほぼかかりません。
 
         Parameters:
-            x1 (int): 交換するブロック1のx座標
-            y1 (int): 交換するブロック1のy座標
-            x2 (int): 交換するブロック2のx座標
-            y2 (int): 交換するブロック2のy座標
-            isSelf (bool): 自分自身が行う操作かどうか
+            history (int): 保持するtickの数
         """
-        super().swap_block(x1, y1, x2, y2)
-        if isSelf:
-            if self.isHost:
-                for client in self.clients:
-                    try:
-                        client.conn.send(f"swap_block,{x1},{y1},{x2},{y2};".encode("utf-8"))
-                    except:
-                        self.clients.remove(client)
-            else:
-                self.server.send(f"swap_block,{x1},{y1},{x2},{y2};".encode("utf-8"))
-    
-    def multiplayer_server(self):
+        self.history = collections.deque(maxlen=history)
+        self.phases = collections.defaultdict(float)
+        self.block_time = collections.defaultdict(float)
+        self.block_count = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self.tick_start = None
+
+    def begin_tick(self):
         """
-        マルチプレイヤーサーバーを開始し、クライアントからの接続を待機します。
-        接続が確立されると、新しいConnectionオブジェクトを作成し、
-        クライアントリストに追加します。
+        tickの開始時刻を記録します。
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind((self.address, self.port))
-        sock.listen(5)
-        while True:
-            conn, addr = sock.accept()
-            self.clients.append(Connection(conn, addr, self, True))
-            send_data = [0 for _ in range(self.width * self.height)]
-            i = 0
-            for x in range(self.width):
-                for y in range(self.height):
-                    send_data[i] = self.get_block_id(x, y)
-                    i += 1
-            conn.send(f"sync_world,{','.join(map(str, send_data))};".encode("utf-8"))
-            
-    def sync_world(self, data):
+        self.tick_start = time.perf_counter()
+
+    def end_tick(self, world:World):
         """
-        サーバーから送られてきたワールドデータを受け取り、
-        ワールドデータを更新します。
+        tickの終了時に、そのtickで集計した値をhistoryに追加してリセットします。
+
+        Parameters:
+            world (World): 更新したワールド
         """
-        i = 0
-        for x in range(self.width):
-            for y in range(self.height):
-                self.set_block(x, y, data[i], 1, False)
-                i += 1
+        self.history.append({
+            "tick": time.perf_counter() - self.tick_start,
+            "phases": dict(self.phases),
+            "block_time": dict(self.block_time),
+            "block_count": dict(self.block_count),
+            "counters": dict(self.counters),
+            "active_chunks": world.active_chunk_count,
+        })
+        self.phases.clear()
+        self.block_time.clear()
+        self.block_count.clear()
+        self.counters.clear()
 
+    def add(self, phase:str, seconds:float):
+        """
+        phaseにかかった時間を加算します。
 
-    def multiplayer_client(self):
+        Parameters:
+            phase (str): フェーズの名前
+            seconds (float): かかった秒数
         """
-        マルチプレイヤークライアントを開始し、サーバーとの接続を確立します。
-        サーバーとの接続が確立されると、新しいConnectionオブジェクトを作成し
-        そのオブジェクトをconnectionに格納します。
+        self.phases[phase] += seconds
+
+    def add_block(self, name:str, seconds:float):
         """
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.connect((self.address, self.port))
-        self.connection = Connection(self.server, self.address, self, False)
+        ブロックの種類ごとのupdate()にかかった時間と回数を加算します。
 
+        Parameters:
+            name (str): ブロックのクラス名
+            seconds (float): かかった秒数
+        """
+        self.block_time[name] += seconds
+        self.block_count[name] += 1
 
-class Connection:
-    def __init__(self, conn:socket, addr:str, world:MultiPlayer, isHostSide:bool = False):
+    def count(self, name:str, n:int = 1):
         """
-        Connectionオブジェクトを初期化します.
+        nameの回数をn回分加算します。
 
         Parameters:
-            conn (socket): サーバーとクライアントの間でデータをやり取りするためのソケット
-            addr (str): クライアントのIPアドレス
-            world (MultiPlayer): マルチプレイヤーワールド
-            isHost (bool): サーバー役かどうか
+            name (str): カウンターの名前
+            n (int): 加算する回数
         """
-        self.conn = conn
-        self.addr = addr
-        self.world = world
-        self.isHostSide = isHostSide
-        threading.Thread(target=self.recv_loop, daemon=True).start()
+        self.counters[name] += n
 
-    def recv_loop(self):
+    def summary(self) -> dict:
         """
-        クライアント・サーバーから送られてきたコマンドを処理します.
+        historyに残っているtickの平均を返します。
 
-        1024バイトずつ受信し、";"で区切られたコマンドを処理します。
-        例えば、"set_block,1,2,3;"というコマンドがあった場合、
-        "set_block"というコマンドに[1,2,3]という引数を渡します。
-        また、ホスト役の場合は、全てのクライアントに同じコマンドを送信します。
+        Returns:
+            dict: tick時間(秒)、フェーズごとの時間(秒)、ブロックごとの時間(秒)と回数、
+                  カウンター、起きているチャンク数の、1tickあたりの平均
         """
-        buffer = ""
-        raw_command = ""
-        loop = True
-        while loop:
-            try:
-                data = self.conn.recv(1024)
-            except:
-                loop = False
-                self.conn.close()
-                self.world.clients.remove(self)
-            decoded = data.decode("utf-8")
-            if not data:
-                loop = False
-                self.conn.close()
-                self.world.clients.remove(self)
-                break
+        n = len(self.history)
+        result = {"ticks": n, "tick": 0.0, "phases": {}, "block_time": {}, "block_count": {}, "counters": {}, "active_chunks": 0.0}
+        if n == 0:
+            return result
+        for record in self.history:
+            result["tick"] += record["tick"] / n
+            result["active_chunks"] += record["active_chunks"] / n
+            for key in ("phases", "block_time", "block_count", "counters"):
+                for name, value in record[key].items():
+                    result[key][name] = result[key].get(name, 0) + value / n
+        return result
 
-            if self.isHostSide:
-                for client in self.world.clients:
-                    if client.addr != self.addr:
-                        client.conn.send(data)
-
-            buffer += decoded
-            while True:
-                if ";" in buffer:
-                    i = buffer.find(";")
-                    raw_command = buffer[:i]
-                    buffer = buffer[i+1:]
-                    try:
-                        command = raw_command.split(",")
-                        args = [int(i) for i in command[1:]]
-                        self.do_command(command[0], args)
-                    except:
-                        print("Error in command")
-                        print(raw_command)
-                else:
-                    break
-    
-    def do_command(self, command:str, args:list):
+    def lines(self) -> list:
         """
-        指定されたコマンドを実行します.
+        画面に表示するための文字列のリストを返します。
 
-        Parameters:
-            command (str): 実行するコマンド
-            args (list): コマンドに渡す引数
-        """
-        if command == "set_block":
-            self.world.set_block(args[0], args[1], args[2], args[3], False)
-        elif command =="swap_block":
-            self.world.swap_block(args[0], args[1], args[2], args[3], False)
-        elif command =="sync_world":
-            self.world.sync_world(args)
-                
-
-class Block:
-    def __init__(self):
-        self.vx = 0
-        self.vy = 0
-        self.dead = False
-        self.can_burn = False
-        self.burn_level = 0
-        self.burn_threshold = 10
-        self.fire = False
-        self.fire_chance = 0.0
-        self.speed_decay = 0.99
-        self.gravity = 1
-        self.color = (0, 0, 0)
-        self.invisible = False
-        self.move_priority = 100
-        self.last_tick = 0
-        self.isGround = False
-        self.next_blocks = [None, None, None, None] #up, right, down, left
-        self.can_electric = False
-        self.electric_level = 0
-        self.durability = 10000
-        self.transform = None
-        self.transform_to = None
-    def update(self):
+        Returns:
+            list: 1行ずつの文字列
+        """
+        summary = self.summary()
+        lines = [f"tick {summary['tick']*1000:.2f}ms  chunks {summary['active_chunks']:.0f}"]
+        for name, seconds in sorted(summary["phases"].items(), key=lambda item: -item[1]):
+            lines.append(f"{name} {seconds*1000:.2f}ms")
+        for name, n in sorted(summary["counters"].items()):
+            lines.append(f"{name} {n:.0f}/tick")
+        for name, seconds in sorted(summary["block_time"].items(), key=lambda item: -item[1])[:5]:
+            lines.append(f"{name} {seconds*1000:.2f}ms x{summary['block_count'][name]:.0f}")
+        return lines
+
+
+max_block_id = 254
+block_types = {}
+
+
+class BlockType(type):
+    """
+    ブロックのクラスのメタクラスです。
+    ブロックの定数は全てのセルで共有され、Worldが作る時にテーブルへコピーされるため、
+    定義した後に書き換えたり、インスタンスを作ったりできないようにします。
+    値を変えたいときは、サブクラスを作って別のidで登録してください。
+    """
+    def __setattr__(cls, name, value):
+        raise AttributeError(f"{cls.__name__}.{name} is a shared block constant and cannot be changed")
+
+    def __delattr__(cls, name):
+        raise AttributeError(f"{cls.__name__}.{name} is a shared block constant and cannot be deleted")
+
+    def __call__(cls, *args, **kwargs):
+        raise TypeError(f"{cls.__name__} is a block type; per-cell state lives in the World arrays")
+
+
+def register_block(block:type, id:int = None) -> type:
+    """
+    ブロックの種類を、idを付けて登録します。
+    クラスの中で id = 番号 と書いたBlockのサブクラスは、定義した時に自動で登録されます。
+    idはセーブデータや通信でそのまま使うため、一度決めたら変えないでください。
+    idは0からmax_block_idまでで、255はMultiPlayerが再送の印に使うため登録できません。
+    登録より前に作ったWorldには反映されません。
+
+    Parameters:
+        block (type): 登録するブロックのクラス
+        id (int): ブロックのid (Noneならクラスのidをそのまま使います)
+    Returns:
+        type: 登録したブロックのクラス
+    """
+    if id is not None:
+        type.__setattr__(block, "id", id)
+    if not isinstance(block.id, int) or not 0 <= block.id <= max_block_id:
+        raise ValueError(f"{block.__name__}: block id must be 0..{max_block_id}, got {block.id!r}")
+    registered = block_types.get(block.id)
+    if registered is not None and registered is not block:
+        raise ValueError(f"{block.__name__}: block id {block.id} is already used by {registered.__name__}")
+    block_types[block.id] = block
+    return block
+
+
+def block_list() -> list:
+    """
+    登録されたブロックを、idを添字にしたリストで返します。
+    使われていないidの場所にはAirが入ります。
+
+    Returns:
+        list: idの順に並べたブロックのクラスのリスト
+    """
+    return [block_types.get(id, Air) for id in range(max(block_types)+1)]
+
+
+class Block(metaclass=BlockType):
+    """
+    ブロックの種類ごとの定数をまとめたパラメータテーブルです。
+    セルごとの状態(速度、燃焼度、耐久値など)はWorldのNumPy配列に格納されるため、
+    ブロックはインスタンス化せず、クラスのまま使います。
+
+    ブロックのidはクラスの id に書きます。idを書かなかったサブクラスは登録されません。
+    """
+    id = None
+    can_burn = False
+    burn_threshold = 10
+    fire_chance = 0.0
+    speed_decay = 0.99
+    gravity = 1
+    color = (0, 0, 0)
+    invisible = False
+    move_priority = 100
+    can_electric = False
+    durability = 10000
+    lifetime = 0
+    transform_to = None
+    kernel = "scalar"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "id" in cls.__dict__:
+            register_block(cls)
+        else:
+            type.__setattr__(cls, "id", None)
+
+    @classmethod
+    def update(cls, world, x, y):
         return 0, 0
-    
-    def impact(self, count, x, y, direction_from):
-        if count <= 0:
-            return
-        for i in range(4):
-            if i == direction_from:
-                continue
-            if self.next_blocks[i] is not None:
-                self.next_blocks[i].impact(count-1, x, y, direction_from)
-        self.vx, self.vy = x, y
-        self.durability -= math.sqrt(self.vx**2 + self.vy**2)
-        if self.durability <= 0 and self.transform_to is not None:
-            self.transform = self.transform_to
-        
-    def electric(self, level):
-        if level <= 0 or self.can_electric == False or self.electric_level >= level:
-            return
-        if self.electric_level < level:
-            self.electric_level = level
-        for i in range(4):
-            if self.next_blocks[i] is not None:
-                self.next_blocks[i].electric(level-1)
-    
 
-class Stone(Block):
-    def __init__(self):
-        super().__init__()
-        self.color = (100, 100, 100)
-        self.transform_to = Sand
-        self.durability = 200
+    @classmethod
+    def impact(cls, world, x, y, count, vx, vy, direction_from):
+        """
+        x, y座標からcount-1マス先までのブロックに、vx, vyの速度と、その大きさの分の損傷を与えます。
+        direction_fromの方向(next_offsetsの順番)には広がりません。
+        各ブロックには1回だけ、キューを使って順番に与えます。
+        """
+        frontier = collections.deque([(x, y, count)])
+        visited = {(x, y)}
+        while frontier:
+            x, y, count = frontier.popleft()
+            if count <= 0:
+                continue
+            for i, (dx, dy) in enumerate(next_offsets):
+                nx, ny = x+dx, y+dy
+                if i != direction_from and 0 <= nx < world.width and 0 <= ny < world.height and (nx, ny) not in visited:
+                    visited.add((nx, ny))
+                    frontier.append((nx, ny, count-1))
+            block = world.get_block(x, y)
+            world.vx[x, y], world.vy[x, y] = vx, vy
+            world.durability[x, y] -= math.sqrt(vx**2 + vy**2)
+            world.wake(x, y)
+            if world.durability[x, y] <= 0 and block.transform_to is not None:
+                world.transform[x, y] = block.transform_to.id
 
-    def impact(self, count, x, y, direction_from):
-        return super().impact(count, x, y, direction_from)
+    @classmethod
+    def electric(cls, world, x, y, level):
+        world.propagate_electric(x, y, level)
 
 
 class Air(Block):
-    def __init__(self):
-        super().__init__()
-        self.invisible = True
-        self.color = (255, 255, 255)
-        self.move_priority = 0
+    id = 0
+    kernel = "static"
+    invisible = True
+    color = (255, 255, 255)
+    move_priority = 0
 
 
 class Sand(Block):
-    def __init__(self):
-        super().__init__()
-        self.color = (220, 200, 170)
-        self.move_priority = 3
-    
-    def update(self):
-        self.vx *= self.speed_decay
-        self.vy *= self.speed_decay
-        mvx, mvy = self.vx, self.vy + self.gravity
-        if self.isGround:
-            if self.next_blocks[1] is not None and self.next_blocks[1].move_priority < self.move_priority:
+    id = 2
+    kernel = "powder"
+    color = (220, 200, 170)
+    move_priority = 3
+
+    @classmethod
+    def update(cls, world, x, y):
+        world.vx[x, y] *= cls.speed_decay
+        world.vy[x, y] *= cls.speed_decay
+        mvx, mvy = float(world.vx[x, y]), float(world.vy[x, y]) + cls.gravity
+        if world.is_ground[x, y]:
+            if x+1 < world.width and world.get_block(x+1, y).move_priority < cls.move_priority:
                 mvx += 1
-            elif self.next_blocks[3] is not None and self.next_blocks[3].move_priority < self.move_priority:
+            elif x-1 >= 0 and world.get_block(x-1, y).move_priority < cls.move_priority:
                 mvx -= 1
         return int(mvx), int(mvy)
 
 
+class Stone(Block):
+    id = 1
+    kernel = "static"
+    color = (100, 100, 100)
+    transform_to = Sand
+    durability = 200
+
+
 class Water(Block):
-    def __init__(self):
-        super().__init__()
-        self.color = (0, 0, 255)
-        self.move_priority = 2
-
-    def update(self):
-        self.vx *= self.speed_decay
-        self.vy *= self.speed_decay
-        mvx, mvy = self.vx, self.vy
-        if self.isGround:
-            if random.random() < 0.5:
+    id = 3
+    kernel = "liquid"
+    color = (0, 0, 255)
+    move_priority = 2
+
+    @classmethod
+    def update(cls, world, x, y):
+        world.vx[x, y] *= cls.speed_decay
+        world.vy[x, y] *= cls.speed_decay
+        mvx, mvy = float(world.vx[x, y]), float(world.vy[x, y])
+        if world.is_ground[x, y]:
+            if world.random(x, y) < 0.5:
                 mvx += -1
             else:
                 mvx += 1
         else:
-            mvy += self.gravity
+            mvy += cls.gravity
         return int(mvx), int(mvy)
 
 
 class Fire(Block):
-    def __init__(self):
-        super().__init__()
-        self.lifetime = 120
-        self.color = (255, 0, 0)
-        self.move_priority = 1
-
-    def update(self):
-        self.vx *= self.speed_decay
-        self.vy *= self.speed_decay
-        mvx, mvy = self.vx, self.vy
-        self.lifetime -= 1
-        for i in range(4):
-            block = self.next_blocks[i]
-            if block is not None and block.can_burn:
-                block.burn_level += 1
-                
-        r = random.random()
+    id = 4
+    lifetime = 120
+    color = (255, 0, 0)
+    move_priority = 1
+
+    @classmethod
+    def update(cls, world, x, y):
+        world.vx[x, y] *= cls.speed_decay
+        world.vy[x, y] *= cls.speed_decay
+        mvx, mvy = float(world.vx[x, y]), float(world.vy[x, y])
+        world.lifetime[x, y] -= 1
+        world.wake(x, y)
+        world.heat_sources.append((x, y))
+
+        r = world.random(x, y)
         if r < 0.4:
             mvy -= 1
         elif r < 0.7:
@@ -596,100 +2898,71 @@ class Fire(Block):
         elif r < 0.98:
             mvx -= 1
         else:
-            self.dead = True
-        if self.lifetime <= 0:
-            self.dead = True
+            world.transform[x, y] = 0
+        if world.lifetime[x, y] <= 0:
+            world.transform[x, y] = 0
         return int(mvx), int(mvy)
-    
 
-class Wood(Block):
-    def __init__(self):
-        super().__init__()
-        self.color = (150, 75, 0)
-        self.can_burn = True
-        self.burn_threshold = 10
-        self.fire_chance = 0.4
-        self.durability = 10
-        self.transform_to = WoodDust
-    
-    def update(self):
-        if self.burn_level >= self.burn_threshold:
-            self.fire = True
-        return 0, 0
-    
-    def impact(self, count, x, y, direction_from):
-        return super().impact(count, x, y, direction_from)
-    
 
 class WoodDust(Sand):
-    def __init__(self):
-        super().__init__()
-        self.color = (200, 125, 0)
-        self.can_burn = True
-        self.burn_threshold = 3
-        self.fire_chance = 0.6
-    
-    def update(self):
-        mvx, mvy = super().update()
-        if self.burn_level >= self.burn_threshold:
-            self.fire = True
-        return mvx, mvy
+    id = 10
+    color = (200, 125, 0)
+    can_burn = True
+    burn_threshold = 3
+    fire_chance = 0.6
+
+
+class Wood(Block):
+    id = 5
+    kernel = "static"
+    color = (150, 75, 0)
+    can_burn = True
+    burn_threshold = 10
+    fire_chance = 0.4
+    durability = 10
+    transform_to = WoodDust
 
 
 class Oil(Water):
-    def __init__(self):
-        super().__init__()
-        self.move_priority = 1.5
-        self.color = (200, 200, 0)
-        self.can_burn = True
-        self.burn_threshold = 5
-        self.fire_chance = 1.0
-
-    def update(self):
-        mvx, mvy = super().update()
-        if self.burn_level >= self.burn_threshold:
-            self.fire = True
-        return mvx, mvy
+    id = 6
+    move_priority = 1.5
+    color = (200, 200, 0)
+    can_burn = True
+    burn_threshold = 5
+    fire_chance = 1.0
 
 
 class Gunpowder(Sand):
-    def __init__(self):
-        super().__init__()
-        self.color = (200, 200, 200)
-        self.can_burn = True
-        self.burn_threshold = 1
-        self.fire_chance = 1
-    
-    def update(self):
-        mvx, mvy = super().update()
-        if self.burn_level >= self.burn_threshold:
-            xlist = [0, 1, 0, -1]
-            ylist = [1, 0, -1, 0]
-            power = 5
-            for i in range(4):
-                if self.next_blocks[i] is not None:
-                    self.next_blocks[i].impact(4, xlist[i]*power, ylist[i]*power, (i+2)%4)
-            self.fire = True
+    id = 7
+    color = (200, 200, 200)
+    can_burn = True
+    burn_threshold = 1
+    fire_chance = 1
+    blast_power = 5
+    blast_radius = 4
+
+    @classmethod
+    def update(cls, world, x, y):
+        mvx, mvy = super().update(world, x, y)
+        if world.burn_level[x, y] >= cls.burn_threshold:
+            world.detonations.append((x, y, cls.blast_power, cls.blast_radius))
         return mvx, mvy
 
 class Fuse(Wood):
-    def __init__(self):
-        super().__init__()
-        self.color = (200, 50, 0)
-        self.burn_threshold = 1
-        self.fire_chance = 1.0
-        self.transform_to = None
+    id = 8
+    color = (200, 50, 0)
+    burn_threshold = 1
+    fire_chance = 1.0
+    transform_to = None
 
 class Iron(Block):
-    def __init__(self):
-        super().__init__()
-        self.color = (150, 150, 150)
-        self.transform_to = None
+    id = 9
+    kernel = "static"
+    color = (150, 150, 150)
+    transform_to = None
 
 
-pygame.init()
-pygame.display.set_mode((800, 500))
-world_data = World(160, 100)
+world_data = None
 
 def pygame_input(out:str, error:str = ""):
     clock = pygame.time.Clock()
@@ -720,30 +2993,52 @@ def pygame_input(out:str, error:str = ""):
 
 
 
-def main():
+def main(world:World = None):
+    """
+    ウィンドウを開いてゲームを開始します。
+    pygameの初期化はここで初めて行うため、モジュールのimportやstep()だけならディスプレイは不要です。
+
+    Parameters:
+        world (World): 最初に表示するワールド (Noneの場合は160x100の空のワールド)
+    """
     global world_data, multiplayer, isHost
-    screen = pygame.display.get_surface()
+    pygame.init()
+    if world is None:
+        world = World(160, 100)
+    world_data = world
+    view_x, view_y, view_x1, view_y1 = world_data.view
+    screen = pygame.display.set_mode(((view_x1 - view_x)*block_w, (view_y1 - view_y)*block_w))
     runnning = True
     clock = pygame.time.Clock()
     mouse_event = None
     mouse_button_holding = [False, False]
     place_size = 1
-    blocks = world_data.blocks
+    blocks = [block_types[id] for id in sorted(block_types)]
+    block_ids = [block.id for block in blocks]
     sel = 0
     clipboard = []
-    temp_save = []
+    quicksave = "quicksave.w2d"
+    save_thread = None
     mode = "normal" #normal, copy, paste
     copy_x, copy_y = 0, 0
+    font = pygame.font.SysFont(None, 15)
+    world_data.renderer = Renderer(world_data)
+    scheduler = Scheduler(tick_rate=60, frame_rate=60, max_steps=5)
+    overlay_rects = []
     while runnning:
-        world_data.update(screen)
+        scheduler.run_ticks(world_data)
+        dirty_rects = world_data.draw(screen)
+        world_data.renderer.restore(screen, overlay_rects)
+        dirty_rects += overlay_rects
+        overlay_rects = []
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                if multiplayer:
-                    if isHost:
-                        for client in world_data.clients:
-                            client.conn.close()
-                    else:
-                        world_data.server.close()
+                if save_thread is not None:
+                    save_thread.join()
+                if world_data.autosave is not None:
+                    world_data.autosave.close()
+                if isinstance(world_data, (MultiPlayer, StreamedWorld)):
+                    world_data.close()
                 runnning = False
             else:
                 if event.type == pygame.MOUSEBUTTONDOWN:
@@ -753,13 +3048,8 @@ def main():
                     elif event.button == 3:
                         mouse_button_holding[1] = True
                     if event.button == 2:
-                        x, y = event.pos[0] // block_w, event.pos[1] // block_w
-                        block = world_data.data[x][y].__class__
-                        if block in blocks:
-                            for i in range(len(blocks)):
-                                if blocks[i] == block:
-                                    sel = i
-                                    break
+                        x, y = event.pos[0] // block_w + view_x, event.pos[1] // block_w + view_y
+                        sel = world_data.get_block_id(x, y)
                 if event.type == pygame.MOUSEBUTTONUP:
                     if event.button == 1:
                         mouse_button_holding[0] = False
@@ -787,26 +3077,41 @@ def main():
                     if event.key == pygame.K_7:
                         sel = 7
                     if event.key == pygame.K_a:
-                        next_sel = sel - 1
-                        if next_sel >= 0:
-                            sel = next_sel
+                        next_index = block_ids.index(sel) - 1
+                        if next_index >= 0:
+                            sel = blocks[next_index].id
                     if event.key == pygame.K_d:
-                        next_sel = sel + 1
-                        if next_sel < len(blocks):
-                            sel = next_sel
+                        next_index = block_ids.index(sel) + 1
+                        if next_index < len(blocks):
+                            sel = blocks[next_index].id
                     if event.key == pygame.K_r:
                         for x in range(world_data.width):
                             for y in range(world_data.height):
                                 world_data.set_block(x, y, 0)
+                    if isinstance(world_data, StreamedWorld):
+                        if event.key == pygame.K_LEFT:
+                            world_data.move_window(-1, 0)
+                        if event.key == pygame.K_RIGHT:
+                            world_data.move_window(1, 0)
+                        if event.key == pygame.K_UP:
+                            world_data.move_window(0, -1)
+                        if event.key == pygame.K_DOWN:
+                            world_data.move_window(0, 1)
+                    if event.key == pygame.K_F3:
+                        world_data.stats = TickStats() if world_data.stats is None else None
                     if event.key == pygame.K_w:
                         place_size += 1
                     if event.key == pygame.K_s and place_size > 1:
                         place_size -= 1
-                    if event.key == pygame.K_o:
-                        temp_save = world_data.export_world()
-                    if event.key == pygame.K_p:
-                        world_data.import_world(temp_save)
+                    if event.key == pygame.K_o and (save_thread is None or not save_thread.is_alive()):
+                        save_thread = world_data.save_world_async(quicksave)
+                    if event.key == pygame.K_p and os.path.exists(quicksave):
+                        if save_thread is not None:
+                            save_thread.join()
+                        # 次の o で同じファイルを置き換えるため、メモリマップを残さないように読み込みます
+                        world_data.restore_world(quicksave, use_mmap=False)
                     if event.key == pygame.K_m and multiplayer == False:
+                        previous = world_data
                         out = "Are you host? (yes/no/cancel): "
                         error = ""
                         while True:
@@ -829,7 +3134,7 @@ def main():
                                 if port == "cancel":
                                     break
                                 try:
-                                    world_data = MultiPlayer(160, 100, True, int(port), "")
+                                    world_data = MultiPlayer(160, 100, True, int(port), "", batched=world_data.batched)
                                     break
                                 except Exception as e:
                                     print(e)
@@ -844,15 +3149,24 @@ def main():
                                 if port == "cancel":
                                     break
                                 try:
-                                    world_data = MultiPlayer(160, 100, False, int(port), ip)
+                                    world_data = MultiPlayer(160, 100, False, int(port), ip, batched=world_data.batched)
                                     break
                                 except:
                                     error = "Invalid input"
-                                
+                        if world_data is not previous:
+                            if previous.autosave is not None:
+                                previous.autosave.close()
+                            if isinstance(previous, StreamedWorld):
+                                previous.close()
+                        view_x, view_y, view_x1, view_y1 = world_data.view
+                        screen = pygame.display.set_mode(((view_x1 - view_x)*block_w, (view_y1 - view_y)*block_w))
+                        world_data.renderer = Renderer(world_data)
+                        dirty_rects += world_data.renderer.draw(screen)
+
 
                     if mouse_event != None:
                         if event.key == pygame.K_c:
-                            x, y = int(mouse_event.pos[0]//block_w), int(mouse_event.pos[1]//block_w)
+                            x, y = int(mouse_event.pos[0]//block_w) + view_x, int(mouse_event.pos[1]//block_w) + view_y
                             if mode == "copy":
                                 x1, y1 = max(copy_x, x), max(copy_y, y)
                                 x2, y2 = min(copy_x, x), min(copy_y, y)
@@ -869,7 +3183,7 @@ def main():
                             elif mode == "normal":
                                 mode = "paste"
         if mouse_event != None:
-            x, y = int(mouse_event.pos[0]//block_w), int(mouse_event.pos[1]//block_w)
+            x, y = int(mouse_event.pos[0]//block_w) + view_x, int(mouse_event.pos[1]//block_w) + view_y
             if mouse_button_holding[0]:
                 for i in range(place_size):
                     for j in range(place_size):
@@ -885,29 +3199,96 @@ def main():
             if mode == "paste":
                 paste_size_x = len(clipboard)
                 paste_size_y = len(clipboard[0])
-                pygame.draw.rect(screen, (0, 0, 255), ((x - paste_size_x//2)*block_w, (y - paste_size_y//2)*block_w, block_w*paste_size_x, block_w*paste_size_y), 1)
+                overlay_rects.append(pygame.draw.rect(screen, (0, 0, 255), ((x - paste_size_x//2 - view_x)*block_w, (y - paste_size_y//2 - view_y)*block_w, block_w*paste_size_x, block_w*paste_size_y), 1))
             elif mode == "copy":
                 x1, y1 = max(copy_x, x), max(copy_y, y)
                 x2, y2 = min(copy_x, x), min(copy_y, y)
                 wx, wy = x1 - x2, y1 - y2
-                pygame.draw.rect(screen, (0, 255, 0), (x2*block_w, y2*block_w, block_w*wx, block_w*wy), 1)
+                overlay_rects.append(pygame.draw.rect(screen, (0, 255, 0), ((x2 - view_x)*block_w, (y2 - view_y)*block_w, block_w*wx, block_w*wy), 1))
             elif mode == "normal":
-                pygame.draw.rect(screen, (255, 0, 0), ((x - place_size//2)*block_w, (y - place_size//2)*block_w, block_w*place_size, block_w*place_size), 1)
+                overlay_rects.append(pygame.draw.rect(screen, (255, 0, 0), ((x - place_size//2 - view_x)*block_w, (y - place_size//2 - view_y)*block_w, block_w*place_size, block_w*place_size), 1))
         
         for i, block in enumerate(blocks):
-            if i == sel:
+            if block.id == sel:
                 stroke = 1
             else:
                 stroke = 0
-            pygame.draw.rect(screen, block().color, (blocks.index(block)*60, 10, 60, 20), stroke)
+            overlay_rects.append(pygame.draw.rect(screen, block.color, (i*60, 10, 60, 20), stroke))
 
-            font = pygame.font.SysFont(None, 15)
             text = font.render(block.__name__, True, (255, 255, 255))
-            screen.blit(text, (blocks.index(block)*60, 15))
-        pygame.display.update()
-        clock.tick(60)
+            overlay_rects.append(screen.blit(text, (i*60, 15)))
+        if world_data.stats is not None:
+            for i, line in enumerate(world_data.stats.lines()):
+                text = font.render(line, True, (255, 255, 0), (0, 0, 0))
+                overlay_rects.append(screen.blit(text, (10, 40 + i*12)))
+        pygame.display.update(dirty_rects + overlay_rects)
+        clock.tick(scheduler.frame_rate)
     pygame.quit()
 
+def headless(world:World, ticks:int) -> dict:
+    """
+    描画を行わずにworldをticks回更新し、処理速度を計測します。
+
+    Parameters:
+        world (World): 更新するワールド
+        ticks (int): 更新するtick数
+    Returns:
+        dict: tick数、経過秒数、1秒あたりのtick数とセル数、最後に起きていたチャンク数
+    """
+    start = time.perf_counter()
+    for _ in range(ticks):
+        world.step()
+    elapsed = time.perf_counter() - start
+    ticks_per_second = ticks / elapsed if elapsed > 0 else float("inf")
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_second": ticks_per_second,
+        "cells_per_second": ticks_per_second * world.width * world.height,
+        "active_chunks": world.active_chunk_count,
+    }
+
+
 if __name__ == "__main__": 
-    main()
+    parser = argparse.ArgumentParser(description="World2D")
+    parser.add_argument("world", nargs="?", help="読み込むワールドのファイル")
+    parser.add_argument("--headless", action="store_true", help="ウィンドウを開かずにシミュレーションだけを行う")
+    parser.add_argument("--ticks", type=int, default=600, help="--headless で更新するtick数")
+    parser.add_argument("--size", default="160x100", help="新しく作るワールドの大きさ (幅x高さ)")
+    parser.add_argument("--batched", action="store_true", help="静止している砂や液体をNumPyでまとめて移動させる (山の形は1ブロックずつ更新する場合と少し異なります)")
+    parser.add_argument("--save", help="--headless の終了後にワールドを保存するファイル")
+    parser.add_argument("--seed", type=int, help="シミュレーションの乱数のシード")
+    parser.add_argument("--workers", type=int, default=0, help="チャンクを市松模様に分けて並列に更新するプロセス数")
+    parser.add_argument("--infinite", help="座標に限りの無いワールドのチャンクを保存するディレクトリ (--sizeはカメラに映す大きさになります)")
+    parser.add_argument("--cache-mb", type=int, default=32, help="--infinite で窓の外のチャンクをメモリに置いておく上限(MB)")
+    parser.add_argument("--autosave", help="自動保存するファイル名の前半 (指定した時だけ自動保存します)")
+    parser.add_argument("--autosave-interval", type=int, default=3600, help="自動保存する間隔のtick数")
+    parser.add_argument("--autosave-keep", type=int, default=3, help="残しておく自動保存のファイル数")
+    args = parser.parse_args()
+
+    batched = args.batched
+    if args.infinite:
+        w, h = map(int, args.size.lower().split("x"))
+        world = StreamedWorld(w, h, args.infinite, args.cache_mb << 20, batched=batched, seed=args.seed)
+    elif args.world:
+        world = World.load_world(args.world, batched, args.seed, args.workers)
+    else:
+        w, h = map(int, args.size.lower().split("x"))
+        world = World(w, h, batched, args.seed, args.workers)
+    if args.autosave:
+        world.autosave = Autosave(world, args.autosave, args.autosave_interval, args.autosave_keep)
+    if args.headless:
+        result = headless(world, args.ticks)
+        if world.autosave is not None:
+            world.autosave.close()
+        if isinstance(world, StreamedWorld):
+            world.close()
+        print(f"{result['ticks']} ticks in {result['seconds']:.3f}s: "
+              f"{result['ticks_per_second']:.1f} ticks/s, "
+              f"{result['cells_per_second']/1e6:.2f} Mcells/s, "
+              f"{result['active_chunks']} active chunks")
+        if args.save:
+            world.save_world(args.save)
+    else:
+        main(world)
         
\ No newline at end of file